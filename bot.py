@@ -3,193 +3,496 @@ import os
 for proxy_var in ['HTTP_PROXY', 'HTTPS_PROXY', 'http_proxy', 'https_proxy', 'ALL_PROXY', 'all_proxy', 'NO_PROXY', 'no_proxy']:
     os.environ.pop(proxy_var, None)
 
-from telebot.async_telebot import AsyncTeleBot
-from telebot import types
-import json
-import tempfile
+from telebot.async_telebot import AsyncTeleBot, ExceptionHandler
+from telebot import types, asyncio_helper
+import itertools
+import re
+import time
+import traceback
 import asyncio
-from config import BOT_TOKEN, OPENAI_API_KEY, DATA_DIR, ADMIN_IDS
+from contextvars import ContextVar
+from config import (BOT_TOKEN, OPENAI_API_KEY, ADMIN_IDS, OPENAI_MAX_CONNECTIONS, OPENAI_MAX_RETRIES, STREAM_RESPONSES,
+                    RECIPE_CACHE_SIZE, RECIPE_CACHE_TTL, RECIPE_CACHE_PERSIST, PHOTO_CACHE_SIZE, PHOTO_HASH_DISTANCE,
+                    VISION_MAX_SIDE, STATE_BACKEND, STATE_TTL, STATE_MAX_ENTRIES, TELEGRAM_API_URL,
+                    TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, CHAT_TOKEN_BUDGET, CHAT_HISTORY_TURNS, WEB_CONCURRENCY)
+from storage import (get_receipt, get_receipts, get_receipt_items, recipe_id_at, add_receipt, add_receipts, add_comment,
+                     get_recipe_comments, get_comments_page, get_recipe_titles_page, get_recipe_title,
+                     record_ingredient_request, run_io, cache_stats as storage_cache_stats)
+from search import search_recipes
+from cache import TTLCache
+from state import make_state_store
+from ratelimit import openai_slot, RateLimited
+from outbound import SendScheduler
+from images import load_photo, hamming, pick_photo_size, prepare_for_vision
+from formatting import TELEGRAM_LIMIT, to_telegram_markdown, split_head, split_markdown
+from conversation import new_conversation, build_messages, record_turn, chat_stats
+from router import Router, encode_id, decode_id
+from bulk import FORMATS as EXPORT_FORMATS, detect_format, parse_recipes, export_recipes, recipe_key
+import telemetry
+from telemetry import timed
+
+
+_openai_client = None
+
+
+def get_openai_client():
+    """Return the shared AsyncOpenAI client, creating it on first use.
+    One client (and one pooled httpx connection pool) serves every OpenAI call,
+    so requests reuse keep-alive connections instead of opening new ones.
+    The OpenAI SDK (>=1.x) does not accept a `proxies` kwarg, so we hand it our
+    own httpx client with env proxy detection disabled.
+    """
+    global _openai_client
+    if _openai_client is None:
+        import httpx
+        from openai import AsyncOpenAI
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS,
+                                max_keepalive_connections=OPENAI_MAX_CONNECTIONS),
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            trust_env=False,
+        )
+        # the SDK retries 429s and 5xx with exponential backoff, honouring Retry-After
+        _openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_client, max_retries=OPENAI_MAX_RETRIES)
+    return _openai_client
 
 
-def make_openai_client():
-    """Create an OpenAI client while safely handling proxy settings.
-    The OpenAI SDK (>=1.x) does not accept a `proxies` kwarg, so if a proxy is
-    configured via env vars we attach it using httpx instead of passing it
-    directly. This prevents the "unexpected keyword argument 'proxies'" error.
-    """
-    from openai import OpenAI
-    # Don't use proxy for OpenAI calls - we cleared them above
-    return OpenAI(api_key=OPENAI_API_KEY)
+async def close_openai_client():
+    global _openai_client
+    if _openai_client is not None:
+        await _openai_client.close()
+        _openai_client = None
+
+if TELEGRAM_API_URL:
+    asyncio_helper.API_URL = TELEGRAM_API_URL.rstrip('/') + '/bot{0}/{1}'
+    asyncio_helper.FILE_URL = TELEGRAM_API_URL.rstrip('/') + '/file/bot{0}/{1}'
+
+send_scheduler = SendScheduler(TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, workers=WEB_CONCURRENCY)
+
+
+class PacedTeleBot(AsyncTeleBot):
+    """AsyncTeleBot whose message sends and edits go through `send_scheduler`."""
+
+    async def send_message(self, chat_id, *args, **kwargs):
+        return await send_scheduler.run(chat_id, lambda: super(PacedTeleBot, self).send_message(chat_id, *args, **kwargs))
+
+    async def edit_message_text(self, text, chat_id=None, *args, **kwargs):
+        return await send_scheduler.run(chat_id, lambda: super(PacedTeleBot, self).edit_message_text(text, chat_id, *args, **kwargs))
+
+    async def edit_message_reply_markup(self, chat_id=None, *args, **kwargs):
+        return await send_scheduler.run(chat_id, lambda: super(PacedTeleBot, self).edit_message_reply_markup(chat_id, *args, **kwargs))
+
+    async def send_document(self, chat_id, *args, **kwargs):
+        return await send_scheduler.run(chat_id, lambda: super(PacedTeleBot, self).send_document(chat_id, *args, **kwargs))
+
+
+# exceptions raised by handlers of the update being processed; telebot doesn't re-raise them,
+# so `main.process_update` sets a list here and reports the update as failed
+handler_failures = ContextVar('handler_failures', default=None)
+
+
+class LoggingExceptionHandler(ExceptionHandler):
+    """Log handler failures as structured records tagged with the update's trace id."""
+
+    def handle(self, exception):
+        telemetry.log('handler_failed', level='error', error=repr(exception), traceback=traceback.format_exc())
+        failures = handler_failures.get()
+        if failures is not None:
+            failures.append(exception)
+        return True
+
+
+bot = PacedTeleBot(BOT_TOKEN, exception_handler=LoggingExceptionHandler())
+
+# conversation state per user (see state.py)
+user_states = make_state_store(STATE_BACKEND, STATE_TTL, STATE_MAX_ENTRIES)
+
+# AI recipes keyed by normalized ingredient list
+recipe_cache = TTLCache(RECIPE_CACHE_SIZE, RECIPE_CACHE_TTL, namespace='recipes' if RECIPE_CACHE_PERSIST else None)
+# AI recipes for photos, keyed by Telegram file_unique_id and by perceptual hash (hex)
+photo_cache = TTLCache(PHOTO_CACHE_SIZE, RECIPE_CACHE_TTL, namespace='photos' if RECIPE_CACHE_PERSIST else None)
+photo_hash_cache = TTLCache(PHOTO_CACHE_SIZE, RECIPE_CACHE_TTL, namespace='photo_hashes' if RECIPE_CACHE_PERSIST else None)
+
+COMMENTS_PAGE_SIZE = 10
+# Streaming: seconds between progressive edits, and where a message rolls over to a new one
+STREAM_EDIT_INTERVAL = 1.0
+STREAM_MESSAGE_LIMIT = TELEGRAM_LIMIT
+RECIPES_PAGE_SIZE = 8
+# Share of the user's ingredients a saved recipe must cover to be offered before calling OpenAI
+LOCAL_MATCH_COVERAGE = 0.6
+# Bulk import: largest file the Bot API lets bots download, rows parsed per worker-thread call,
+# seconds between progress updates, errors listed
+IMPORT_MAX_BYTES = 20 * 1024 * 1024
+IMPORT_CHUNK_ROWS = 500
+IMPORT_PROGRESS_INTERVAL = 2.0
+IMPORT_ERRORS_SHOWN = 10
+
+async def _edit_streamed(chat_id, message_id, text, final=False):
+    """Edit a streamed message; the final edit tries Markdown and falls back to plain text."""
+    text = to_telegram_markdown(text) if final else text + ' ▌'
+    if not text.strip():
+        return
+    try:
+        await bot.edit_message_text(text, chat_id, message_id, parse_mode='Markdown' if final else None)
+    except Exception as e:
+        if not final or 'not modified' in str(e):
+            return
+        try:
+            await bot.edit_message_text(text, chat_id, message_id)
+        except Exception:
+            pass
 
-bot = AsyncTeleBot(BOT_TOKEN)
 
-# simple in-memory state per chat
-user_states = {}
+def record_usage(op, usage):
+    """Count the tokens OpenAI reported for one call."""
+    if usage:
+        telemetry.inc('openai_tokens_total', usage.prompt_tokens, op=op, kind='prompt')
+        telemetry.inc('openai_tokens_total', usage.completion_tokens, op=op, kind='completion')
 
-def ensure_data_dir():
-    if not os.path.exists(DATA_DIR):
-        os.makedirs(DATA_DIR, exist_ok=True)
 
-def _load_json(path, default):
+async def stream_completion(chat_id, message_id, error_text, op='recipes', **kwargs):
+    """Stream a chat completion into `message_id`, editing it at most every
+    STREAM_EDIT_INTERVAL seconds and continuing in a new message once it passes
+    STREAM_MESSAGE_LIMIT characters. Returns (full text, True if the stream completed).
+    """
+    parts = []
+    current = ''
+    last_edit = time.monotonic()
+    started = time.monotonic()
+    try:
+        stream = await get_openai_client().chat.completions.create(
+            stream=True, stream_options={'include_usage': True}, **kwargs)
+        async for chunk in stream:
+            record_usage(op, chunk.usage)
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            delta = chunk.choices[0].delta.content
+            parts.append(delta)
+            current += delta
+            if len(current) > STREAM_MESSAGE_LIMIT:
+                # Close the current message on a Markdown-safe break and carry on in a fresh one
+                head, current = split_head(current, STREAM_MESSAGE_LIMIT)
+                await _edit_streamed(chat_id, message_id, head, final=True)
+                msg = await bot.send_message(chat_id, current or '…')
+                message_id = msg.message_id
+                last_edit = time.monotonic()
+            elif time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+                await _edit_streamed(chat_id, message_id, current)
+                last_edit = time.monotonic()
+    except Exception as e:
+        telemetry.observe('external_call_seconds', time.monotonic() - started, service='openai', op=op)
+        telemetry.inc('external_call_seconds_errors_total', service='openai', op=op)
+        telemetry.log('openai_error', level='error', op=op, streamed=True, error=repr(e))
+        if not parts:
+            await _edit_streamed(chat_id, message_id, error_text, final=True)
+            return error_text, False
+        await _edit_streamed(chat_id, message_id, current, final=True)
+        return ''.join(parts).strip(), False
+    telemetry.observe('external_call_seconds', time.monotonic() - started, service='openai', op=op)
+    await _edit_streamed(chat_id, message_id, current, final=True)
+    return ''.join(parts).strip(), True
+
+
+async def complete(error_text, op='recipes', **kwargs):
+    """Non-streaming chat completion. Returns (text, ok), with `error_text` on failure."""
     try:
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except Exception:
-        return default
-
-def _save_json(path, data):
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-def get_receipts():
-    ensure_data_dir()
-    return _load_json(os.path.join(DATA_DIR, 'receipts.json'), [])
-
-def add_receipt(receipt):
-    ensure_data_dir()
-    receipts = get_receipts()
-    receipts.append(receipt)
-    _save_json(os.path.join(DATA_DIR, 'receipts.json'), receipts)
-
-def get_comments():
-    ensure_data_dir()
-    return _load_json(os.path.join(DATA_DIR, 'comments.json'), [])
-
-def add_comment(comment):
-    ensure_data_dir()
-    comments = get_comments()
-    comments.append(comment)
-    _save_json(os.path.join(DATA_DIR, 'comments.json'), comments)
-
-def get_recipe_title(recipe_text):
-    """Extract title from recipe text (first line or first 50 chars)"""
-    lines = recipe_text.strip().split('\n')
-    # Try to find a title-like line
-    for line in lines[:3]:
-        line = line.strip()
-        if line and not line.startswith('Yield') and not line.startswith('Prep'):
-            return line[:80] if len(line) > 80 else line
-    # Fallback: use first 50 chars
-    return recipe_text[:50].replace('\n', ' ') + '...'
-
-
-async def chat_about_recipe(user_question, recipe_context):
-    """Chat with AI about a recipe with off-topic detection."""
+        with timed('external_call_seconds', service='openai', op=op):
+            resp = await get_openai_client().chat.completions.create(**kwargs)
+        record_usage(op, resp.usage)
+        return resp.choices[0].message.content.strip(), True
+    except Exception as e:
+        telemetry.log('openai_error', level='error', op=op, error=repr(e))
+        return error_text, False
+
+
+CHAT_SYSTEM_PROMPT = ("You are a helpful cooking assistant. You only answer questions related to cooking, recipes, "
+                      "ingredients, and food preparation. If the user asks about anything unrelated to cooking or food, "
+                      "politely redirect them to ask about the recipes. Keep responses concise and friendly.")
+
+
+async def chat_about_recipe(user_question, conversation):
+    """Answer a follow-up about the suggested recipes with off-topic detection.
+    Sends a token-budgeted window of `conversation` and records the turn in it on success.
+    """
     if not OPENAI_API_KEY:
         return "I can't access the AI assistant right now."
     
-    client = make_openai_client()
-    
-    def _call_openai():
-        try:
-            resp = client.chat.completions.create(
+    try:
+        with timed('external_call_seconds', service='openai', op='chat'):
+            resp = await get_openai_client().chat.completions.create(
                 model="gpt-4o-mini",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You are a helpful cooking assistant. You only answer questions related to cooking, recipes, ingredients, and food preparation. If the user asks about anything unrelated to cooking or food, politely redirect them to ask about the recipes. Keep responses concise and friendly."
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Here are the recipes I suggested:\n\n{recipe_context}\n\nUser question: {user_question}"
-                    }
-                ],
+                messages=build_messages(CHAT_SYSTEM_PROMPT, conversation, user_question, CHAT_TOKEN_BUDGET),
                 max_tokens=500,
             )
-            return resp.choices[0].message.content.strip()
-        except Exception as e:
-            print(f"OpenAI Chat Error: {e}")
-            return "Sorry, I'm having trouble responding right now. Please try again."
-    
-    loop = asyncio.get_event_loop()
-    result = await loop.run_in_executor(None, _call_openai)
-    return result
-
-
-async def generate_recipe_from_image(image_path, chat_id=None):
-    """Generate recipe text for an image using OpenAI if available.
-    This function will call OpenAI synchronously inside an executor to avoid blocking.
-    If OPENAI_API_KEY is not set, returns a fallback message asking for a text list.
+        record_usage('chat', resp.usage)
+        answer = resp.choices[0].message.content.strip()
+        usage = resp.usage.model_dump() if resp.usage else None
+        record_turn(conversation, user_question, answer, CHAT_HISTORY_TURNS, usage)
+        if usage:
+            telemetry.log('chat_turn', prompt_tokens=usage['prompt_tokens'], completion_tokens=usage['completion_tokens'],
+                          conversation_tokens=conversation['tokens_used'], turns=len(conversation['turns']))
+        return answer
+    except Exception as e:
+        telemetry.log('openai_error', level='error', op='chat', error=repr(e))
+        return "Sorry, I'm having trouble responding right now. Please try again."
+
+
+async def generate_recipe_from_image(image_data, chat_id=None, message_id=None):
+    """Generate recipe text for JPEG image bytes using OpenAI if available.
+    If `message_id` is given the answer is streamed into that message of `chat_id`.
+    Returns (text, ok); if OPENAI_API_KEY is not set, text asks for a text list instead.
     """
     if not OPENAI_API_KEY:
         return ("I can't access the recipe generator right now. "
                 "Please send me a text list of the ingredients instead, "
-                "or set `OPENAI_API_KEY` in your environment.")
+                "or set `OPENAI_API_KEY` in your environment."), False
 
     import base64
-    
-    client = make_openai_client()
 
-    def _call_openai():
-        try:
-            # Read and encode the image
-            with open(image_path, "rb") as image_file:
-                base64_image = base64.b64encode(image_file.read()).decode('utf-8')
-            
-            resp = client.chat.completions.create(
-                model="gpt-4o-mini",  # Using gpt-4o-mini (gpt-5 API access may require specific tier/format)
-                messages=[
+    base64_image = base64.b64encode(image_data).decode('utf-8')
+
+    error_text = ("I'm currently unable to analyze images directly. However, I can help you create recipes "
+                  "based on a list of ingredients you provide! Please send me a text list of your ingredients.")
+    request = dict(
+        model="gpt-4o-mini",  # Using gpt-4o-mini (gpt-5 API access may require specific tier/format)
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": "You are a helpful cooking assistant. Analyze this image of available ingredients and identify what you see. Then provide 2-3 recipe suggestions.\n\nFormat each recipe as:\n\n*Recipe Name*\n\n*Ingredients:*\n• ingredient 1\n• ingredient 2\n\n*Instructions:*\n1. Step one\n2. Step two\n\nUse simple markdown formatting. Keep it concise and friendly. Add relevant emojis for visual appeal."
+                    },
                     {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": "You are a helpful cooking assistant. Analyze this image of available ingredients and identify what you see. Then provide 2-3 recipe suggestions.\n\nFormat each recipe as:\n\n*Recipe Name*\n\n*Ingredients:*\n• ingredient 1\n• ingredient 2\n\n*Instructions:*\n1. Step one\n2. Step two\n\nUse simple markdown formatting. Keep it concise and friendly. Add relevant emojis for visual appeal."
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
-                                }
-                            }
-                        ]
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/jpeg;base64,{base64_image}"
+                        }
                     }
-                ],
-                max_tokens=1000,
-            )
-            return resp.choices[0].message.content.strip()
-        except Exception as e:
-            print(f"OpenAI Error: {e}")  # Log to console for debugging
-            return f"I'm currently unable to analyze images directly. However, I can help you create recipes based on a list of ingredients you provide! Please send me a text list of your ingredients.\n\n(Error: {e})"
+                ]
+            }
+        ],
+        max_tokens=1000,
+    )
+    if message_id is not None:
+        return await stream_completion(chat_id, message_id, error_text, op='vision', **request)
+    try:
+        with timed('external_call_seconds', service='openai', op='vision'):
+            resp = await get_openai_client().chat.completions.create(**request)
+        record_usage('vision', resp.usage)
+        return resp.choices[0].message.content.strip(), True
+    except Exception as e:
+        telemetry.log('openai_error', level='error', op='vision', error=repr(e))
+        return f"{error_text}\n\n(Error: {e})", False
+
+
+def make_page_markup(prefix, page, total, page_size, markup=None):
+    """Inline ◀️/▶️ buttons whose callback data is `{prefix}{page}`, appended to `markup` if given.
+    Returns `markup` unchanged (None if not given) when everything fits on one page.
+    """
+    pages = (total + page_size - 1) // page_size
+    if pages <= 1:
+        return markup
+    if markup is None:
+        markup = types.InlineKeyboardMarkup()
+    buttons = []
+    if page > 0:
+        buttons.append(types.InlineKeyboardButton('◀️ Prev', callback_data=f'{prefix}{page - 1}'))
+    buttons.append(types.InlineKeyboardButton(f'{page + 1}/{pages}', callback_data='noop'))
+    if page < pages - 1:
+        buttons.append(types.InlineKeyboardButton('Next ▶️', callback_data=f'{prefix}{page + 1}'))
+    markup.row(*buttons)
+    return markup
+
 
-    loop = asyncio.get_event_loop()
-    result = await loop.run_in_executor(None, _call_openai)
-    return result
+def make_recipes_page(page):
+    """Build one page of the recipe browser. Returns (markup, total)."""
+    titles, total = get_recipe_titles_page(page * RECIPES_PAGE_SIZE, RECIPES_PAGE_SIZE)
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    for recipe_id, title in titles:
+        markup.add(types.InlineKeyboardButton(f"📖 {title}", callback_data=f"r_{encode_id(recipe_id)}"))
+    return make_page_markup('recipes_page_', page, total, RECIPES_PAGE_SIZE, markup), total
+
+
+def make_search_results_markup(matches):
+    """One button per (recipe_id, coverage, score) search match."""
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    for recipe_id, coverage, _ in matches:
+        r = get_receipt(recipe_id)
+        if r is not None:
+            title = r.get('title') or get_recipe_title(r.get('text', ''))
+            markup.add(types.InlineKeyboardButton(f"📖 {title} ({round(coverage * 100)}%)", callback_data=f"r_{encode_id(recipe_id)}"))
+    return markup
+
+
+async def send_search_results(chat_id, query):
+    matches = await search_recipes(query)
+    if not matches:
+        await bot.send_message(chat_id, '🔎 No saved recipes match those ingredients. Try 🤖 Cook companion AI instead!')
+        return
+    await bot.send_message(chat_id, '🔎 *Matching recipes*\n\nSelect a recipe to view details:', reply_markup=make_search_results_markup(matches), parse_mode='Markdown')
 
 
 def make_main_keyboard(is_admin=False):
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
     markup.row(types.KeyboardButton('🤖 Cook companion AI'), types.KeyboardButton('📚 Find recipes by list'))
+    markup.row(types.KeyboardButton('🔎 Search recipes'))
     if is_admin:
         markup.row(types.KeyboardButton('⚙️ /admin'))
     return markup
 
 
+async def send_recipe_chat_prompt(chat_id, uid, recipe_context):
+    """Offer follow-up questions about freshly generated recipes."""
+    # Create keyboard with home button
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    markup.add(types.KeyboardButton('🏠 Back to Home'))
+    
+    await bot.send_message(chat_id, '💬 Ask me anything about these recipes! (cooking tips, substitutions, variations, etc.)', reply_markup=markup)
+    user_states.set(uid, {'state': 'chatting_about_recipe', 'conversation': new_conversation(recipe_context)})
+
+
+def ingredients_cache_key(ingredients_text):
+    """Normalize an ingredient list to its sorted, de-duplicated items. Every word is
+    kept, so "no nuts" and "nuts" never share a cached answer.
+    """
+    items = (' '.join(item.split()).strip('.') for item in re.split(r'[,;\n]+', ingredients_text.lower()))
+    return ', '.join(sorted({item for item in items if item}))
+
+
+async def send_long_message(chat_id, text, reply_markup=None, markdown=True):
+    """Send text split into message-sized chunks; the markup goes on the last one.
+    A chunk Telegram can't parse as Markdown is resent as plain text.
+    """
+    chunks = split_markdown(text) or [text]
+    for i, chunk in enumerate(chunks):
+        markup = reply_markup if i == len(chunks) - 1 else None
+        if not markdown:
+            await bot.send_message(chat_id, chunk, reply_markup=markup)
+            continue
+        try:
+            await bot.send_message(chat_id, chunk, parse_mode='Markdown', reply_markup=markup)
+        except asyncio_helper.ApiTelegramException as e:
+            if "can't parse entities" not in str(e.description):
+                raise
+            await bot.send_message(chat_id, chunk, reply_markup=markup)
+
+
+async def send_recipe_text(chat_id, result):
+    """Send generated recipe text as Markdown, split to fit Telegram's message limit."""
+    await send_long_message(chat_id, to_telegram_markdown(result))
+
+
+def find_similar_photo(phash):
+    """Cached recipe text for a photo whose perceptual hash is within PHOTO_HASH_DISTANCE bits."""
+    if phash is None:
+        return None
+    best_key, best_distance = None, PHOTO_HASH_DISTANCE + 1
+    for key in photo_hash_cache.keys():
+        distance = hamming(int(key, 16), phash)
+        if distance < best_distance:
+            best_key, best_distance = key, distance
+    return photo_hash_cache.get(best_key) if best_key else None
+
+
+def ingredients_request(ingredients_text):
+    """Chat completion arguments for recipes from a text ingredient list."""
+    return dict(
+        model="gpt-4o-mini",
+        messages=[
+            {
+                "role": "system",
+                "content": "You are a helpful cooking assistant. Generate creative and delicious recipes based on the ingredients provided. Provide clear, step-by-step instructions. Format recipes with clear headers."
+            },
+            {
+                "role": "user",
+                "content": f"Based on these available ingredients, suggest 2-3 creative recipes I can make:\n\n{ingredients_text}\n\nPlease provide detailed recipes with ingredients and instructions."
+            }
+        ],
+        max_tokens=1000,
+    )
+
+
+async def send_recipes_from_ingredients(chat_id, uid, ingredients_text):
+    """Generate recipes for a text ingredient list and switch the user to recipe chat.
+    Answers for the same normalized ingredient set are served from `recipe_cache`,
+    which popular lists are pre-generated into (see pregen.py).
+    """
+    key = ingredients_cache_key(ingredients_text)
+    if key:
+        record_ingredient_request(key, ingredients_text)
+    cached = recipe_cache.get(key) if key else None
+    if cached:
+        await send_recipe_text(chat_id, cached)
+        await send_recipe_chat_prompt(chat_id, uid, cached)
+        return
+
+    # Call OpenAI to generate recipes from text description
+    if not OPENAI_API_KEY:
+        await bot.send_message(chat_id, "I can't access the AI assistant right now.")
+        return
+    
+    error_text = "Sorry, I'm having trouble generating recipes right now. Please try again."
+    request = ingredients_request(ingredients_text)
+    try:
+        async with openai_slot(uid):
+            status = await bot.send_message(chat_id, '🔍 Processing your ingredients... this may take a few seconds.')
+            if STREAM_RESPONSES:
+                result, ok = await stream_completion(chat_id, status.message_id, error_text, **request)
+            else:
+                result, ok = await complete(error_text, **request)
+    except RateLimited as e:
+        await bot.send_message(chat_id, e.user_message())
+        return
+    if not STREAM_RESPONSES:
+        await send_recipe_text(chat_id, result)
+    if ok and key:
+        recipe_cache.set(key, result)
+    await send_recipe_chat_prompt(chat_id, uid, result)
+
+
 @bot.message_handler(commands=['start'])
+@timed('handler_seconds', handler='start')
 async def start_handler(message: types.Message):
     is_admin = message.from_user and (message.from_user.id in ADMIN_IDS)
     text = (
         "🍽️ Glad to assist you today! Choose an option:\n"
         "🤖 Cook companion AI\n"
-        "📚 Find recipes by list\n\n"
+        "📚 Find recipes by list\n"
+        "🔎 Search recipes\n\n"
         "Send /help for more info."
     )
     await bot.send_message(message.chat.id, text, reply_markup=make_main_keyboard(is_admin))
 
 
 @bot.message_handler(commands=['help'])
+@timed('handler_seconds', handler='help')
 async def help_handler(message: types.Message):
     help_text = (
         "🍳 *Welcome to Cooking Bot!*\n\n"
         "Use the bot to get recipe suggestions from a photo or from saved recipes.\n\n"
         "🤖 *Cook companion AI* - Send a photo of your available ingredients.\n"
-        "📚 *Find recipes by list* - Browse saved recipes from the database.\n\n"
+        "📚 *Find recipes by list* - Browse saved recipes from the database.\n"
+        "🔎 *Search recipes* - Find saved recipes by ingredients, e.g. `/search eggs, milk, flour`.\n\n"
         "⚙️ Admins can use /admin to add recipes or review comments."
     )
     await bot.send_message(message.chat.id, help_text, parse_mode='Markdown')
 
 
+@bot.message_handler(commands=['search'])
+@timed('handler_seconds', handler='search')
+async def search_handler(message: types.Message):
+    uid = message.from_user.id if message.from_user else message.chat.id
+    query = message.text.partition(' ')[2].strip()
+    if query:
+        await send_search_results(message.chat.id, query)
+        return
+    user_states.set(uid, {'state': 'awaiting_search_query'})
+    await bot.send_message(message.chat.id, '🔎 Send me the ingredients you have (e.g. eggs, milk, flour):')
+
+
 @bot.message_handler(commands=['admin'])
+@timed('handler_seconds', handler='admin')
 async def admin_handler(message: types.Message):
     if not message.from_user or message.from_user.id not in ADMIN_IDS:
         await bot.send_message(message.chat.id, "You are not authorized to use admin commands.")
@@ -198,280 +501,374 @@ async def admin_handler(message: types.Message):
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton('➕ Add recipe', callback_data='admin_add'))
     markup.add(types.InlineKeyboardButton('💬 Review comments', callback_data='admin_review'))
+    markup.add(types.InlineKeyboardButton('📥 Import recipes', callback_data='admin_import'),
+               types.InlineKeyboardButton('📤 Export recipes', callback_data='admin_export'))
+    markup.add(types.InlineKeyboardButton('📊 Cache stats', callback_data='admin_stats'))
     await bot.send_message(message.chat.id, '⚙️ Admin panel:', reply_markup=markup)
 
 
+async def send_recipes_export(chat_id, fmt):
+    items = await run_io(get_receipt_items)
+    if not items:
+        await bot.send_message(chat_id, 'No recipes available yet.')
+        return
+    data = await asyncio.to_thread(export_recipes, items, fmt)
+    await bot.send_document(chat_id, data, visible_file_name=f'recipes.{fmt}',
+                            caption=f'📤 {len(items)} recipes')
+
+
+@bot.message_handler(commands=['export'])
+@timed('handler_seconds', handler='export')
+async def export_handler(message: types.Message):
+    if not message.from_user or message.from_user.id not in ADMIN_IDS:
+        await bot.send_message(message.chat.id, "You are not authorized to use admin commands.")
+        return
+    fmt = message.text.partition(' ')[2].strip().lower() or 'jsonl'
+    if fmt not in EXPORT_FORMATS:
+        await bot.send_message(message.chat.id, 'Usage: /export [jsonl|csv]')
+        return
+    await send_recipes_export(message.chat.id, fmt)
+
+
+async def import_recipes(chat_id, uid, data, fmt):
+    """Parse an uploaded JSONL/CSV file, reporting progress, and store its valid,
+    new recipes in one transaction. Rows identical to a stored recipe are skipped.
+    """
+    status = await bot.send_message(chat_id, '📥 Reading the file...')
+    known = {recipe_key(r) for r in await run_io(get_receipts)}
+    receipts, errors, duplicates = [], [], 0
+    last_report = time.monotonic()
+    rows = parse_recipes(data, fmt)
+    n = 0
+    while True:
+        # decoding, JSON parsing and validation run in a worker thread, a chunk of rows at a time
+        chunk = await asyncio.to_thread(list, itertools.islice(rows, IMPORT_CHUNK_ROWS))
+        if not chunk:
+            break
+        for where, receipt, error in chunk:
+            if error:
+                errors.append(f"{where}: {error}" if where else error)
+            elif recipe_key(receipt) in known:
+                duplicates += 1
+            else:
+                known.add(recipe_key(receipt))
+                receipt['added_by'] = uid
+                receipts.append(receipt)
+        n += len(chunk)
+        if time.monotonic() - last_report >= IMPORT_PROGRESS_INTERVAL:
+            await bot.edit_message_text(f'📥 Read {n} rows...', chat_id, status.message_id)
+            last_report = time.monotonic()
+    if receipts:
+        await bot.edit_message_text(f'💾 Saving {len(receipts)} recipes...', chat_id, status.message_id)
+        await run_io(add_receipts, receipts)
+    lines = [f'✅ Imported {len(receipts)} recipes.']
+    if duplicates:
+        lines.append(f'Skipped {duplicates} already saved.')
+    if errors:
+        lines.append(f'{len(errors)} rows with errors:')
+        lines.extend(errors[:IMPORT_ERRORS_SHOWN])
+        if len(errors) > IMPORT_ERRORS_SHOWN:
+            lines.append('…')
+    await bot.edit_message_text('\n'.join(lines), chat_id, status.message_id)
+    telemetry.log('recipes_imported', format=fmt, imported=len(receipts), duplicates=duplicates, errors=len(errors))
+
+
+callback_routes = Router('callback')
+text_routes = Router('text')
+
+
 @bot.callback_query_handler(func=lambda c: True)
+@timed('handler_seconds', handler='callback_query')
 async def callback_query(call: types.CallbackQuery):
-    data = call.data
-    uid = call.from_user.id
-    if data == 'admin_add':
-        await bot.answer_callback_query(call.id)
-        await bot.send_message(call.message.chat.id, '📝 First, send the recipe *title*:', parse_mode='Markdown')
-        user_states[uid] = {'state': 'awaiting_recipe_title'}
-    elif data == 'admin_review':
-        await bot.answer_callback_query(call.id)
-        comments = get_comments()
-        if not comments:
-            await bot.send_message(call.message.chat.id, 'No comments yet.')
-            return
-        text = 'Comments:\n' + '\n---\n'.join([f"{c.get('user','unknown')}: {c.get('text','')}" for c in comments])
-        await bot.send_message(call.message.chat.id, text)
-    elif data.startswith('recipe_'):
-        await bot.answer_callback_query(call.id)
-        try:
-            recipe_idx = int(data.split('_')[1])
-            receipts = get_receipts()
-            if 0 <= recipe_idx < len(receipts):
-                recipe = receipts[recipe_idx]
-                recipe_text = recipe.get('text', '')
-                title = recipe.get('title') or get_recipe_title(recipe_text)
-                
-                # Format and send recipe
-                formatted = f"*{title}*\n\n{recipe_text}"
-                
-                # Split if too long
-                if len(formatted) > 4000:
-                    parts = []
-                    current = ""
-                    for line in formatted.split('\n'):
-                        if len(current) + len(line) + 1 > 4000:
-                            parts.append(current)
-                            current = line + '\n'
-                        else:
-                            current += line + '\n'
-                    if current:
-                        parts.append(current)
-                    
-                    for part in parts:
-                        await bot.send_message(call.message.chat.id, part, parse_mode='Markdown')
-                else:
-                    await bot.send_message(call.message.chat.id, formatted, parse_mode='Markdown')
-                
-                # Add show comments button
-                markup = types.InlineKeyboardMarkup()
-                markup.add(types.InlineKeyboardButton('📝 Show Comments', callback_data=f'show_comments_{recipe_idx}'))
-                
-                await bot.send_message(call.message.chat.id, '💬 Please leave your feedback or comment about this recipe:', reply_markup=markup)
-                user_states[uid] = {'state': 'awaiting_recipe_comment', 'recipe_idx': recipe_idx}
-        except Exception as e:
-            await bot.send_message(call.message.chat.id, f'Error loading recipe: {e}')
-    elif data.startswith('show_comments_'):
-        await bot.answer_callback_query(call.id)
-        try:
-            recipe_idx = int(data.split('_')[2])
-            comments = get_comments()
-            receipts = get_receipts()
+    await bot.answer_callback_query(call.id)
+    handler, arg = callback_routes.match_callback(call.data or '')
+    if handler is not None:
+        await handler(call, call.from_user.id, arg)
+
+
+@callback_routes.callback('admin_add')
+async def on_admin_add(call, uid, arg):
+    if uid not in ADMIN_IDS:
+        return
+    await bot.send_message(call.message.chat.id, '📝 First, send the recipe *title*:', parse_mode='Markdown')
+    user_states.set(uid, {'state': 'awaiting_recipe_title'})
+
+
+@callback_routes.callback('admin_review', prefix='admin_review_')
+async def on_admin_review(call, uid, arg):
+    if uid not in ADMIN_IDS:
+        return
+    page = int(arg) if arg else 0
+    comments, total = get_comments_page(page * COMMENTS_PAGE_SIZE, COMMENTS_PAGE_SIZE)
+    if not total:
+        await bot.send_message(call.message.chat.id, 'No comments yet.')
+        return
+    text = 'Comments:\n' + '\n---\n'.join([f"{c.get('user','unknown')}: {c.get('text','')}" for c in comments])
+    markup = make_page_markup('admin_review_', page, total, COMMENTS_PAGE_SIZE)
+    # ten comments of up to 4096 characters each can exceed one message
+    await send_long_message(call.message.chat.id, text, reply_markup=markup, markdown=False)
+
+
+@callback_routes.callback('admin_stats')
+async def on_admin_stats(call, uid, arg):
+    if uid not in ADMIN_IDS:
+        return
+    lines = ['📊 Cache stats:']
+    for name, stats in (('Storage reads', storage_cache_stats), ('AI recipes', recipe_cache.stats()),
+                        ('Photos', photo_cache.stats()), ('Similar photos', photo_hash_cache.stats())):
+        hits, misses = stats['hits'], stats['misses']
+        rate = hits / (hits + misses) if hits + misses else 0.0
+        lines.append(f"{name}: {hits} hits / {misses} misses ({rate:.0%})")
+    lines.append(f"Outgoing Telegram queue: {send_scheduler.queue_depth()} waiting, "
+                 f"{send_scheduler.stats['retries_429']} flood-limit retries")
+    lines.append(f"Recipe chat: {chat_stats['turns']} turns, {chat_stats['prompt_tokens']} prompt / "
+                 f"{chat_stats['completion_tokens']} completion tokens")
+    await bot.send_message(call.message.chat.id, '\n'.join(lines))
+
+
+@callback_routes.callback('admin_import')
+async def on_admin_import(call, uid, arg):
+    if uid not in ADMIN_IDS:
+        return
+    user_states.set(uid, {'state': 'awaiting_recipe_import'})
+    await bot.send_message(call.message.chat.id,
+                           '📥 Send a .jsonl file (one {"title": ..., "text": ...} object per line), '
+                           'a .json file with an array of such objects, '
+                           'or a .csv file with "title" and "text" columns.')
+
+
+@callback_routes.callback('admin_export', prefix='admin_export_')
+async def on_admin_export(call, uid, arg):
+    if uid not in ADMIN_IDS:
+        return
+    if arg in EXPORT_FORMATS:
+        await send_recipes_export(call.message.chat.id, arg)
+        return
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton('JSONL', callback_data='admin_export_jsonl'),
+               types.InlineKeyboardButton('CSV', callback_data='admin_export_csv'))
+    await bot.send_message(call.message.chat.id, '📤 Export format:', reply_markup=markup)
+
+
+@callback_routes.callback('ai_from_text')
+async def on_ai_from_text(call, uid, arg):
+    st = user_states.get(uid)
+    if st and st.get('ingredients'):
+        await send_recipes_from_ingredients(call.message.chat.id, uid, st['ingredients'])
+
+
+@callback_routes.callback(prefix='recipes_page_')
+async def on_recipes_page(call, uid, arg):
+    markup, _ = make_recipes_page(int(arg))
+    await bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=markup)
+
+
+async def show_recipe(call, uid, recipe_id):
+    try:
+        recipe = get_receipt(recipe_id)
+        if recipe is not None:
+            recipe_text = recipe.get('text', '')
+            title = recipe.get('title') or get_recipe_title(recipe_text)
             
-            if 0 <= recipe_idx < len(receipts):
-                recipe = receipts[recipe_idx]
-                title = recipe.get('title') or get_recipe_title(recipe.get('text', ''))
-                
-                # Filter comments for this specific recipe
-                recipe_comments = [c for c in comments if c.get('recipe_idx') == recipe_idx]
+            await send_long_message(call.message.chat.id, f"*{title}*\n\n{recipe_text}")
+            
+            # Add show comments button
+            markup = types.InlineKeyboardMarkup()
+            markup.add(types.InlineKeyboardButton('📝 Show Comments', callback_data=f'rc_{encode_id(recipe_id)}'))
+            
+            await bot.send_message(call.message.chat.id, '💬 Please leave your feedback or comment about this recipe:', reply_markup=markup)
+            user_states.set(uid, {'state': 'awaiting_recipe_comment', 'recipe_id': recipe_id})
+    except Exception as e:
+        await bot.send_message(call.message.chat.id, f'Error loading recipe: {e}')
+
+
+async def show_comments(call, recipe_id, page):
+    try:
+        recipe = get_receipt(recipe_id)
+        if recipe is not None:
+            title = recipe.get('title') or get_recipe_title(recipe.get('text', ''))
+            
+            # Only this recipe's comments, one page at a time
+            offset = page * COMMENTS_PAGE_SIZE
+            recipe_comments, total = get_recipe_comments(recipe_id, offset, COMMENTS_PAGE_SIZE)
+            
+            if not total:
+                await bot.send_message(call.message.chat.id, f'📝 *Comments for {title}*\n\nNo comments yet. Be the first to leave feedback!', parse_mode='Markdown')
+            else:
+                comment_text = f'📝 *Comments for {title}*\n\n'
+                for i, c in enumerate(recipe_comments, offset + 1):
+                    user = c.get('user', 'Anonymous')
+                    text = c.get('text', '')
+                    comment_text += f"{i}. *{user}*: {text}\n\n"
                 
-                if not recipe_comments:
-                    await bot.send_message(call.message.chat.id, f'📝 *Comments for {title}*\n\nNo comments yet. Be the first to leave feedback!', parse_mode='Markdown')
-                else:
-                    comment_text = f'📝 *Comments for {title}*\n\n'
-                    for i, c in enumerate(recipe_comments, 1):
-                        user = c.get('user', 'Anonymous')
-                        text = c.get('text', '')
-                        comment_text += f"{i}. *{user}*: {text}\n\n"
-                    
-                    await bot.send_message(call.message.chat.id, comment_text, parse_mode='Markdown')
-        except Exception as e:
-            await bot.send_message(call.message.chat.id, f'Error loading comments: {e}')
-    else:
-        await bot.answer_callback_query(call.id)
+                markup = make_page_markup(f'rc_{encode_id(recipe_id)}_', page, total, COMMENTS_PAGE_SIZE)
+                await send_long_message(call.message.chat.id, comment_text, reply_markup=markup)
+    except Exception as e:
+        await bot.send_message(call.message.chat.id, f'Error loading comments: {e}')
+
+
+@callback_routes.callback(prefix='r_')
+async def on_recipe(call, uid, arg):
+    await show_recipe(call, uid, decode_id(arg))
+
+
+@callback_routes.callback(prefix='rc_')
+async def on_show_comments(call, uid, arg):
+    recipe_id, _, page = arg.partition('_')
+    await show_comments(call, decode_id(recipe_id), int(page) if page else 0)
+
+
+# Buttons sent before recipes had ids carry the recipe's list position
+@callback_routes.callback(prefix='recipe_')
+async def on_legacy_recipe(call, uid, arg):
+    await show_recipe(call, uid, recipe_id_at(int(arg)))
+
+
+@callback_routes.callback(prefix='show_comments_')
+async def on_legacy_show_comments(call, uid, arg):
+    position, _, page = arg.partition('_')
+    await show_comments(call, recipe_id_at(int(position)), int(page) if page else 0)
 
 
 @bot.message_handler(content_types=['text'])
+@timed('handler_seconds', handler='text')
 async def text_handler(message: types.Message):
     uid = message.from_user.id if message.from_user else message.chat.id
     txt = message.text.strip()
-
-    # admin: saving new recipe
     st = user_states.get(uid)
-    if st and st.get('state') == 'awaiting_recipe_title':
-        user_states[uid] = {'state': 'awaiting_recipe_text', 'title': txt}
-        await bot.send_message(message.chat.id, f'✅ Title: *{txt}*\n\nNow send the full recipe text (ingredients and instructions):', parse_mode='Markdown')
+    handler = text_routes.match_text(txt, st.get('state') if st else None)
+    await handler(message, uid, txt, st)
+
+
+def display_name(message, uid):
+    """Username, else full name, else a placeholder for comments."""
+    user = message.from_user
+    if user and user.username:
+        return user.username
+    if user and user.first_name:
+        return f"{user.first_name} {user.last_name}" if user.last_name else user.first_name
+    return f"User {uid}"
+
+
+# admin: saving new recipe
+@text_routes.state('awaiting_recipe_title', capture=True)
+async def on_recipe_title(message, uid, txt, st):
+    user_states.set(uid, {'state': 'awaiting_recipe_text', 'title': txt})
+    await bot.send_message(message.chat.id, f'✅ Title: *{txt}*\n\nNow send the full recipe text (ingredients and instructions):', parse_mode='Markdown')
+
+
+@text_routes.state('awaiting_recipe_text', capture=True)
+async def on_recipe_text(message, uid, txt, st):
+    title = st.get('title', 'Untitled Recipe')
+    receipt = {'added_by': uid, 'title': title, 'text': txt}
+    await run_io(add_receipt, receipt)
+    await bot.send_message(message.chat.id, f'Recipe "*{title}*" saved successfully! ✅', reply_markup=make_main_keyboard(uid in ADMIN_IDS), parse_mode='Markdown')
+    user_states.pop(uid, None)
+
+
+@text_routes.button('🤖 Cook companion AI', 'Cook companion AI')
+async def on_cook_companion(message, uid, txt, st):
+    user_states.set(uid, {'state': 'awaiting_ingredients_photo'})
+    await bot.send_message(message.chat.id, 'Glad to assist you today. Send me a photo of available ingredients and I will provide possible recipes.')
+
+
+@text_routes.button('📚 Find recipes by list', 'Find recipes by list')
+async def on_find_recipes(message, uid, txt, st):
+    markup, total = make_recipes_page(0)
+    if not total:
+        await bot.send_message(message.chat.id, 'No recipes available yet.')
         return
     
-    if st and st.get('state') == 'awaiting_recipe_text':
-        title = st.get('title', 'Untitled Recipe')
-        receipt = {'added_by': uid, 'title': title, 'text': txt}
-        add_receipt(receipt)
-        await bot.send_message(message.chat.id, f'Recipe "*{title}*" saved successfully! ✅', reply_markup=make_main_keyboard(uid in ADMIN_IDS), parse_mode='Markdown')
-        user_states.pop(uid, None)
-        return
+    await bot.send_message(
+        message.chat.id, 
+        '📚 *Available Recipes*\n\nSelect a recipe to view details:', 
+        reply_markup=markup,
+        parse_mode='Markdown'
+    )
+    user_states.set(uid, {'state': 'browsing_recipes'})
 
-    if txt == '🤖 Cook companion AI' or txt == 'Cook companion AI':
-        user_states[uid] = {'state': 'awaiting_ingredients_photo'}
-        await bot.send_message(message.chat.id, 'Glad to assist you today. Send me a photo of available ingredients and I will provide possible recipes.')
-        return
 
-    if txt == '📚 Find recipes by list' or txt == 'Find recipes by list':
-        receipts = get_receipts()
-        if not receipts:
-            await bot.send_message(message.chat.id, 'No recipes available yet.')
-            return
-        
-        # Create inline keyboard with recipe titles
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        for i, r in enumerate(receipts):
-            recipe_text = r.get('text', '')
-            title = r.get('title') or get_recipe_title(recipe_text)
-            button = types.InlineKeyboardButton(
-                f"📖 {title}",
-                callback_data=f"recipe_{i}"
-            )
-            markup.add(button)
-        
-        await bot.send_message(
-            message.chat.id, 
-            '📚 *Available Recipes*\n\nSelect a recipe to view details:', 
-            reply_markup=markup,
-            parse_mode='Markdown'
-        )
-        user_states[uid] = {'state': 'browsing_recipes'}
-        return
+@text_routes.button('🔎 Search recipes', 'Search recipes')
+async def on_search_button(message, uid, txt, st):
+    user_states.set(uid, {'state': 'awaiting_search_query'})
+    await bot.send_message(message.chat.id, '🔎 Send me the ingredients you have (e.g. eggs, milk, flour):')
+
+
+@text_routes.button('🏠 Back to Home')
+async def on_home(message, uid, txt, st):
+    is_admin = message.from_user and (message.from_user.id in ADMIN_IDS)
+    user_states.pop(uid, None)
+    await bot.send_message(message.chat.id, '🏠 Welcome back! Choose an option:', reply_markup=make_main_keyboard(is_admin))
 
-    if txt == '🏠 Back to Home':
-        is_admin = message.from_user and (message.from_user.id in ADMIN_IDS)
-        user_states.pop(uid, None)
-        await bot.send_message(message.chat.id, '🏠 Welcome back! Choose an option:', reply_markup=make_main_keyboard(is_admin))
-        return
 
-    # AI chat about recipe
-    if st and st.get('state') == 'chatting_about_recipe':
-        recipe_context = st.get('recipe_context', '')
-        response = await chat_about_recipe(txt, recipe_context)
-        
-        # Format the response properly
-        formatted_response = response.replace('###', '🍳').replace('**', '*')
-        
-        # Create keyboard with home button
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        markup.add(types.KeyboardButton('🏠 Back to Home'))
-        
-        await bot.send_message(message.chat.id, formatted_response, parse_mode='Markdown', reply_markup=markup)
+@text_routes.state('awaiting_search_query')
+async def on_search_query(message, uid, txt, st):
+    await send_search_results(message.chat.id, txt)
+    user_states.pop(uid, None)
+
+
+# AI chat about recipe
+@text_routes.state('chatting_about_recipe')
+async def on_recipe_chat(message, uid, txt, st):
+    # states saved before conversations were tracked only carry the recipe text
+    conversation = st.get('conversation') or new_conversation(st.get('recipe_context', ''))
+    try:
+        async with openai_slot(uid):
+            response = await chat_about_recipe(txt, conversation)
+    except RateLimited as e:
+        await bot.send_message(message.chat.id, e.user_message())
         return
+    user_states.set(uid, {'state': 'chatting_about_recipe', 'conversation': conversation})
     
-    # comments flow
-    if st and st.get('state') == 'awaiting_recipe_comment':
-        # Get user display name with fallbacks
-        if message.from_user:
-            if message.from_user.username:
-                username = message.from_user.username
-            elif message.from_user.first_name:
-                username = message.from_user.first_name
-                if message.from_user.last_name:
-                    username += f" {message.from_user.last_name}"
-            else:
-                username = f"User {uid}"
-        else:
-            username = f"User {uid}"
-        
-        recipe_idx = st.get('recipe_idx')
-        comment = {'user': username, 'user_id': uid, 'text': txt, 'recipe_idx': recipe_idx}
-        add_comment(comment)
-        await bot.send_message(message.chat.id, 'Thank you for your comment! 🙏\n\n🏠 Returning to Home...', reply_markup=make_main_keyboard(uid in ADMIN_IDS))
-        user_states.pop(uid, None)
-        return
+    # Create keyboard with home button
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    markup.add(types.KeyboardButton('🏠 Back to Home'))
     
-    # Handle comment after browsing recipes (general comment, not linked to specific recipe)
-    if st and st.get('state') == 'browsing_recipes':
-        # Get user display name with fallbacks
-        if message.from_user:
-            if message.from_user.username:
-                username = message.from_user.username
-            elif message.from_user.first_name:
-                username = message.from_user.first_name
-                if message.from_user.last_name:
-                    username += f" {message.from_user.last_name}"
-            else:
-                username = f"User {uid}"
-        else:
-            username = f"User {uid}"
-        
-        comment = {'user': username, 'user_id': uid, 'text': txt, 'recipe_idx': None}
-        add_comment(comment)
-        await bot.send_message(message.chat.id, 'Thank you for your feedback! 🙏\n\n🏠 Returning to Home...', reply_markup=make_main_keyboard(uid in ADMIN_IDS))
-        user_states.pop(uid, None)
+    await send_long_message(message.chat.id, to_telegram_markdown(response), reply_markup=markup)
+
+
+# comments flow
+@text_routes.state('awaiting_recipe_comment')
+async def on_recipe_comment(message, uid, txt, st):
+    recipe_id = st.get('recipe_id')
+    if recipe_id is None and st.get('recipe_idx') is not None:
+        recipe_id = recipe_id_at(st['recipe_idx'])  # state saved before recipes had ids
+    comment = {'user': display_name(message, uid), 'user_id': uid, 'text': txt, 'recipe_id': recipe_id}
+    await run_io(add_comment, comment)
+    await bot.send_message(message.chat.id, 'Thank you for your comment! 🙏\n\n🏠 Returning to Home...', reply_markup=make_main_keyboard(uid in ADMIN_IDS))
+    user_states.pop(uid, None)
+
+
+# Handle comment after browsing recipes (general comment, not linked to specific recipe)
+@text_routes.state('browsing_recipes')
+async def on_general_comment(message, uid, txt, st):
+    comment = {'user': display_name(message, uid), 'user_id': uid, 'text': txt, 'recipe_id': None}
+    await run_io(add_comment, comment)
+    await bot.send_message(message.chat.id, 'Thank you for your feedback! 🙏\n\n🏠 Returning to Home...', reply_markup=make_main_keyboard(uid in ADMIN_IDS))
+    user_states.pop(uid, None)
+
+
+# Handle text ingredients list when awaiting_ingredients_photo
+@text_routes.state('awaiting_ingredients_photo')
+async def on_ingredients_text(message, uid, txt, st):
+    # Answer from the recipe book first when it covers most of the list
+    matches = [m for m in await search_recipes(txt) if m[1] >= LOCAL_MATCH_COVERAGE]
+    if matches:
+        markup = make_search_results_markup(matches)
+        markup.add(types.InlineKeyboardButton('🤖 Generate new recipes with AI', callback_data='ai_from_text'))
+        await bot.send_message(message.chat.id, '📚 I found saved recipes that use these ingredients:', reply_markup=markup)
+        user_states.set(uid, {'state': 'awaiting_ingredients_photo', 'ingredients': txt})
         return
+    await send_recipes_from_ingredients(message.chat.id, uid, txt)
 
-    # Handle text ingredients list when awaiting_ingredients_photo
-    if st and st.get('state') == 'awaiting_ingredients_photo':
-        # User sent text description of ingredients instead of photo
-        ingredients_text = txt
-        await bot.send_message(message.chat.id, '🔍 Processing your ingredients... this may take a few seconds.')
-        
-        # Call OpenAI to generate recipes from text description
-        if not OPENAI_API_KEY:
-            await bot.send_message(message.chat.id, "I can't access the AI assistant right now.")
-            return
-        
-        client = make_openai_client()
-        
-        def _generate_from_text():
-            try:
-                resp = client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": "You are a helpful cooking assistant. Generate creative and delicious recipes based on the ingredients provided. Provide clear, step-by-step instructions. Format recipes with clear headers."
-                        },
-                        {
-                            "role": "user",
-                            "content": f"Based on these available ingredients, suggest 2-3 creative recipes I can make:\n\n{ingredients_text}\n\nPlease provide detailed recipes with ingredients and instructions."
-                        }
-                    ],
-                    max_tokens=1000,
-                )
-                return resp.choices[0].message.content.strip()
-            except Exception as e:
-                print(f"OpenAI Error: {e}")
-                return "Sorry, I'm having trouble generating recipes right now. Please try again."
-        
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(None, _generate_from_text)
-        
-        # Format the response for better readability in Telegram
-        formatted_result = result.replace('###', '🍳').replace('**', '*')
-        
-        # Split long messages if needed (Telegram has 4096 character limit)
-        if len(formatted_result) > 4000:
-            parts = []
-            current_part = ""
-            for line in formatted_result.split('\n'):
-                if len(current_part) + len(line) + 1 > 4000:
-                    parts.append(current_part)
-                    current_part = line + '\n'
-                else:
-                    current_part += line + '\n'
-            if current_part:
-                parts.append(current_part)
-            
-            for part in parts:
-                await bot.send_message(message.chat.id, part, parse_mode='Markdown')
-        else:
-            await bot.send_message(message.chat.id, formatted_result, parse_mode='Markdown')
-        
-        # Create keyboard with home button
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        markup.add(types.KeyboardButton('🏠 Back to Home'))
-        
-        await bot.send_message(message.chat.id, '💬 Ask me anything about these recipes! (cooking tips, substitutions, variations, etc.)', reply_markup=markup)
-        user_states[uid] = {'state': 'chatting_about_recipe', 'recipe_context': result}
-        return
 
-    # fallback
+@text_routes.fallback
+async def on_unknown_text(message, uid, txt, st):
     await bot.send_message(message.chat.id, "I didn't understand that. Send /help for available commands.", reply_markup=make_main_keyboard(uid in ADMIN_IDS))
 
 
 @bot.message_handler(content_types=['photo'])
+@timed('handler_seconds', handler='photo')
 async def photo_handler(message: types.Message):
     uid = message.from_user.id if message.from_user else message.chat.id
     st = user_states.get(uid)
@@ -479,44 +876,73 @@ async def photo_handler(message: types.Message):
         await bot.send_message(message.chat.id, "If you'd like a recipe from a photo, first choose 'Cook companion AI' from the menu.")
         return
 
-    # get best quality photo
-    photo = message.photo[-1]
-    file_info = await bot.get_file(photo.file_id)
+    # smallest photo size that still gives the vision model its full resolution
+    photo = pick_photo_size(message.photo, VISION_MAX_SIDE)
+
+    # Same photo sent or forwarded again: answer without downloading it
+    cached = photo_cache.get(photo.file_unique_id)
+    if cached:
+        await send_recipe_text(message.chat.id, cached)
+        await send_recipe_chat_prompt(message.chat.id, uid, cached)
+        return
+
+    with timed('external_call_seconds', service='telegram', op='get_file'):
+        file_info = await bot.get_file(photo.file_id)
     file_path = file_info.file_path
-    fp = await bot.download_file(file_path)
+    with timed('external_call_seconds', service='telegram', op='download_file'):
+        fp = await bot.download_file(file_path)
+
+    # Decode once, off the event loop; the image is reused for the vision request
+    img, as_is, phash = await asyncio.to_thread(load_photo, fp, VISION_MAX_SIDE)
+    # Near-duplicate of a photo we already answered (re-encoded or resized copy)
+    cached = find_similar_photo(phash)
+    if cached:
+        photo_cache.set(photo.file_unique_id, cached)
+        await send_recipe_text(message.chat.id, cached)
+        await send_recipe_chat_prompt(message.chat.id, uid, cached)
+        return
 
-    # save temporarily
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as tmp:
-        tmp.write(fp)
-        tmp_path = tmp.name
+    image_data = await asyncio.to_thread(prepare_for_vision, fp, img, as_is)
 
-    await bot.send_message(message.chat.id, '🔍 Processing your photo... this may take a few seconds.')
-    result = await generate_recipe_from_image(tmp_path, chat_id=uid)
-    
-    # Format the response for better readability in Telegram
-    formatted_result = result.replace('###', '🍳').replace('**', '*')
-    
-    # Split long messages if needed (Telegram has 4096 character limit)
-    if len(formatted_result) > 4000:
-        parts = []
-        current_part = ""
-        for line in formatted_result.split('\n'):
-            if len(current_part) + len(line) + 1 > 4000:
-                parts.append(current_part)
-                current_part = line + '\n'
+    streaming = STREAM_RESPONSES and OPENAI_API_KEY
+    try:
+        async with openai_slot(uid):
+            status = await bot.send_message(message.chat.id, '🔍 Processing your photo... this may take a few seconds.')
+            if streaming:
+                result, ok = await generate_recipe_from_image(image_data, chat_id=message.chat.id, message_id=status.message_id)
             else:
-                current_part += line + '\n'
-        if current_part:
-            parts.append(current_part)
-        
-        for part in parts:
-            await bot.send_message(message.chat.id, part, parse_mode='Markdown')
-    else:
-        await bot.send_message(message.chat.id, formatted_result, parse_mode='Markdown')
-    
-    # Create keyboard with home button
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    markup.add(types.KeyboardButton('🏠 Back to Home'))
-    
-    await bot.send_message(message.chat.id, '💬 Ask me anything about these recipes! (cooking tips, substitutions, variations, etc.)', reply_markup=markup)
-    user_states[uid] = {'state': 'chatting_about_recipe', 'recipe_context': result}
+                result, ok = await generate_recipe_from_image(image_data, chat_id=message.chat.id)
+    except RateLimited as e:
+        await bot.send_message(message.chat.id, e.user_message())
+        return
+    if not streaming:
+        await send_recipe_text(message.chat.id, result)
+    if ok:
+        photo_cache.set(photo.file_unique_id, result)
+        if phash is not None:
+            photo_hash_cache.set(f'{phash:016x}', result)
+    await send_recipe_chat_prompt(message.chat.id, uid, result)
+
+
+@bot.message_handler(content_types=['document'])
+@timed('handler_seconds', handler='document')
+async def document_handler(message: types.Message):
+    uid = message.from_user.id if message.from_user else message.chat.id
+    st = user_states.get(uid)
+    if uid not in ADMIN_IDS or not st or st.get('state') != 'awaiting_recipe_import':
+        await bot.send_message(message.chat.id, "I can't use files here. Send /help for available commands.")
+        return
+    doc = message.document
+    fmt = detect_format(doc.file_name)
+    if fmt is None:
+        await bot.send_message(message.chat.id, 'Please send a .jsonl, .json or .csv file.')
+        return
+    if doc.file_size and doc.file_size > IMPORT_MAX_BYTES:
+        await bot.send_message(message.chat.id, 'This file is too large (20 MB at most).')
+        return
+    user_states.pop(uid, None)
+    with timed('external_call_seconds', service='telegram', op='get_file'):
+        file_info = await bot.get_file(doc.file_id)
+    with timed('external_call_seconds', service='telegram', op='download_file'):
+        data = await bot.download_file(file_info.file_path)
+    await import_recipes(message.chat.id, uid, data, fmt)
@@ -0,0 +1,119 @@
+"""Bulk recipe import and export as JSONL or CSV.
+
+JSONL and CSV uploads are decoded and parsed one line (or CSV record) at a
+time, so large files are never held as a single string; a .json file holding
+one array of recipe objects is parsed whole. Every row needs a `title` and a
+`text`; other fields are ignored on import. Exports carry the recipe id as
+well, and can be imported again as they are.
+"""
+import csv
+import io
+import json
+
+from storage import get_recipe_title
+
+FORMATS = ('jsonl', 'csv')  # export formats; imports also accept 'json'
+EXTENSIONS = {'.jsonl': 'jsonl', '.ndjson': 'jsonl', '.json': 'json', '.csv': 'csv'}
+EXPORT_FIELDS = ('id', 'title', 'text', 'added_by')
+MAX_TITLE = 200
+MAX_TEXT = 20000
+
+
+def detect_format(filename):
+    """'jsonl', 'json' or 'csv' from the file extension, or None."""
+    name = (filename or '').lower()
+    return next((fmt for ext, fmt in EXTENSIONS.items() if name.endswith(ext)), None)
+
+
+def _rows(stream, fmt):
+    """Yield (location, row dict or None, error or None) from a text stream."""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        if not reader.fieldnames or not {'title', 'text'} <= set(reader.fieldnames):
+            yield 'line 1', None, 'the header must have "title" and "text" columns'
+            return
+        for row in reader:
+            yield f'line {reader.line_num}', row, None
+        return
+    if fmt == 'json':
+        try:
+            rows = json.loads(stream.read())
+        except json.JSONDecodeError as e:
+            yield None, None, f'invalid JSON ({e.msg} at line {e.lineno})'
+            return
+        if not isinstance(rows, list):
+            yield None, None, 'expected a JSON array of recipes'
+            return
+        lines = ((f'item {n}', row) for n, row in enumerate(rows, 1))
+    else:
+        lines = ((f'line {n}', line) for n, line in enumerate(stream, 1) if line.strip())
+    for where, row in lines:
+        if isinstance(row, str):
+            try:
+                row = json.loads(row)
+            except json.JSONDecodeError as e:
+                yield where, None, f'invalid JSON ({e.msg})'
+                continue
+        if not isinstance(row, dict):
+            yield where, None, 'expected a JSON object'
+            continue
+        yield where, row, None
+
+
+def _title(receipt):
+    # recipes saved before titles were asked for get the title shown in the recipe list
+    return receipt.get('title') or get_recipe_title(receipt.get('text', ''))
+
+
+def recipe_key(receipt):
+    """(title, text) as an exported and re-imported row would have them, for spotting
+    recipes that are already saved.
+    """
+    return str(_title(receipt)).strip(), str(receipt.get('text') or '').strip()
+
+
+def _validate(row):
+    title = str(row.get('title') or '').strip()
+    text = str(row.get('text') or '').strip()
+    if not title or not text:
+        return None, 'missing title or text'
+    if len(title) > MAX_TITLE:
+        return None, f'title longer than {MAX_TITLE} characters'
+    if len(text) > MAX_TEXT:
+        return None, f'text longer than {MAX_TEXT} characters'
+    return {'title': title, 'text': text}, None
+
+
+def parse_recipes(data, fmt):
+    """Yield (location, receipt, error) for each row of an uploaded file (bytes);
+    exactly one of receipt and error is None.
+    """
+    stream = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8-sig', newline='')
+    try:
+        for where, row, error in _rows(stream, fmt):
+            if error is None:
+                receipt, error = _validate(row)
+                yield where, receipt, error
+            else:
+                yield where, None, error
+    except UnicodeDecodeError:
+        yield None, None, 'the file is not UTF-8 text'
+    except csv.Error as e:
+        yield None, None, f'invalid CSV ({e})'
+
+
+def export_recipes(items, fmt):
+    """Serialize [(recipe_id, receipt)] as a JSONL or CSV file. Returns bytes."""
+    buf = io.BytesIO()
+    out = io.TextIOWrapper(buf, encoding='utf-8', newline='', write_through=True)
+    rows = ({'id': recipe_id, 'title': _title(r),
+             'text': r.get('text', ''), 'added_by': r.get('added_by')} for recipe_id, r in items)
+    if fmt == 'csv':
+        writer = csv.DictWriter(out, EXPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            out.write(json.dumps(row, ensure_ascii=False) + '\n')
+    out.detach()
+    return buf.getvalue()
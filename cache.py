@@ -0,0 +1,78 @@
+"""Small TTL + LRU caches for generated content.
+
+A `TTLCache` keeps up to `maxsize` entries in memory, evicting the least
+recently used one, and optionally writes through to the `kv_cache` table in
+storage (deferred, see `storage.flush`) so entries survive restarts.
+"""
+import time
+from collections import OrderedDict
+
+import storage
+
+
+class TTLCache:
+    def __init__(self, maxsize, ttl, namespace=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.namespace = namespace  # persist to storage under this name when set
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+        self._loaded = False
+
+    def get(self, key):
+        now = time.time()
+        entry = self._data.get(key)
+        if entry is None and self.namespace:
+            entry = storage.kv_get(self.namespace, key)
+            if entry is not None:
+                self._remember(key, entry)
+        if entry is None or entry[0] < now:
+            if entry is not None:
+                self._data.pop(key, None)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def peek(self, key):
+        """Return (expires_at, value) without counting a hit or miss, or None."""
+        entry = self._data.get(key)
+        if entry is None and self.namespace:
+            entry = storage.kv_get(self.namespace, key)
+        if entry is None or entry[0] < time.time():
+            return None
+        return entry
+
+    def set(self, key, value):
+        entry = (time.time() + self.ttl, value)
+        self._remember(key, entry)
+        if self.namespace:
+            storage.kv_set_deferred(self.namespace, key, value, entry[0])
+
+    def keys(self):
+        """Live keys, loading persisted entries into memory on first call."""
+        if self.namespace and not self._loaded:
+            self._loaded = True
+            for key, expires_at, value in reversed(storage.kv_items(self.namespace, self.maxsize)):
+                self._data.setdefault(key, (expires_at, value))
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        now = time.time()
+        return [k for k, (expires_at, _) in self._data.items() if expires_at >= now]
+
+    def _remember(self, key, entry):
+        self._data[key] = entry
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+        }
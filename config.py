@@ -7,6 +7,54 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 DATA_DIR = os.getenv("DATA_DIR", "./data")
+# SQLite database for recipes and comments (legacy JSON files are migrated on first start)
+DB_PATH = os.getenv("DB_PATH", os.path.join(DATA_DIR, "cooking_bot.db"))
+# Size of the shared OpenAI HTTP connection pool
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+# Stream recipe generation into progressively edited messages (set to 0 to send the full reply at once)
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "1").lower() not in ("0", "false", "no")
+# Cache of AI recipes per normalized ingredient list (entries, seconds, persist to DB_PATH)
+RECIPE_CACHE_SIZE = int(os.getenv("RECIPE_CACHE_SIZE", "1000"))
+RECIPE_CACHE_TTL = int(os.getenv("RECIPE_CACHE_TTL", str(7 * 24 * 3600)))
+RECIPE_CACHE_PERSIST = os.getenv("RECIPE_CACHE_PERSIST", "1").lower() not in ("0", "false", "no")
+# Photo recipe cache size, and max perceptual-hash distance (of 64 bits) treated as the same photo
+PHOTO_CACHE_SIZE = int(os.getenv("PHOTO_CACHE_SIZE", "500"))
+PHOTO_HASH_DISTANCE = int(os.getenv("PHOTO_HASH_DISTANCE", "5"))
+# Longest image edge sent to the vision model; larger photos are downscaled in memory
+VISION_MAX_SIDE = int(os.getenv("VISION_MAX_SIDE", "1024"))
+# Conversation state: "sqlite" (survives restarts) or "memory"; idle seconds before expiry; memory size cap
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+STATE_TTL = int(os.getenv("STATE_TTL", str(24 * 3600)))
+STATE_MAX_ENTRIES = int(os.getenv("STATE_MAX_ENTRIES", "10000"))
+# Number of uvicorn worker processes; more than 1 requires STATE_BACKEND=sqlite
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+# Override the Telegram Bot API endpoint (e.g. a local Bot API server or a test stub)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+# Background update processing: updates processed at once per worker (each from a different chat; raised to
+# at least twice OPENAI_MAX_CONCURRENCY), and total queued updates before answering 503
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "32"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+# OpenAI limits: AI requests per user per minute (and burst), concurrent calls, waiting calls, SDK retries on 429/5xx
+# (bot-wide: with several workers the user limit is shared through the database and each worker gets
+# an equal share of the concurrent and waiting calls)
+USER_RATE_LIMIT = float(os.getenv("USER_RATE_LIMIT", "6"))
+USER_RATE_BURST = int(os.getenv("USER_RATE_BURST", "3"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+OPENAI_MAX_QUEUE = int(os.getenv("OPENAI_MAX_QUEUE", "100"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+# Outgoing Telegram pacing: messages per second for the whole bot and per private chat
+# (bot-wide across all workers: each worker gets an equal share of the global rate)
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+# Recipe chat follow-ups: prompt token budget per request, and recent turns kept verbatim (older ones are summarized)
+CHAT_TOKEN_BUDGET = int(os.getenv("CHAT_TOKEN_BUDGET", "2000"))
+CHAT_HISTORY_TURNS = int(os.getenv("CHAT_HISTORY_TURNS", "6"))
+# Background pre-generation of popular ingredient lists: "batch" (OpenAI Batch API), "direct" (idle-time calls) or "off";
+# seconds between runs, lists per run, requests before a list counts as popular
+PREGEN_MODE = os.getenv("PREGEN_MODE", "batch").lower()
+PREGEN_INTERVAL = int(os.getenv("PREGEN_INTERVAL", "900"))
+PREGEN_BATCH_SIZE = int(os.getenv("PREGEN_BATCH_SIZE", "20"))
+PREGEN_MIN_REQUESTS = int(os.getenv("PREGEN_MIN_REQUESTS", "3"))
 
 # Admin user ID (supports ADMIN_ID for single admin or ADMIN_IDS for comma-separated)
 ADMIN_IDS = []
@@ -0,0 +1,82 @@
+"""Bounded multi-turn history for follow-up questions about generated recipes.
+
+A conversation is a plain dict kept in the user's state: the recipe context,
+the most recent turns and a short summary of older ones. `build_messages`
+packs it into an OpenAI message list that stays within a token budget, so the
+cost of a follow-up does not grow with the length of the conversation.
+"""
+
+CHARS_PER_TOKEN = 4  # rough estimate for English text; the API reports exact usage
+SUMMARY_ITEM_CHARS = 120
+SUMMARY_MAX_CHARS = 600
+
+chat_stats = {'turns': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+
+
+def estimate_tokens(text):
+    return len(text or '') // CHARS_PER_TOKEN + 1
+
+
+def _clip(text, tokens):
+    limit = tokens * CHARS_PER_TOKEN
+    return text if len(text) <= limit else text[:limit].rsplit(' ', 1)[0] + ' …'
+
+
+def new_conversation(recipe_context):
+    return {'recipe_context': recipe_context, 'turns': [], 'summary': '', 'tokens_used': 0}
+
+
+def _summarize(summary, turn):
+    """Fold a dropped turn into the running summary: the question and the start of the answer."""
+    item = f"Q: {turn['q'][:SUMMARY_ITEM_CHARS]} A: {turn['a'][:SUMMARY_ITEM_CHARS]}".replace('\n', ' ')
+    items = (summary.split('\n') if summary else []) + [item]
+    # drop the oldest items if the summary itself grows too long
+    while len(items) > 1 and sum(len(i) + 1 for i in items) > SUMMARY_MAX_CHARS:
+        items.pop(0)
+    return '\n'.join(items)
+
+
+def build_messages(system_prompt, conversation, question, budget, context_share=0.5):
+    """OpenAI messages for `question`: system prompt, recipe context (clipped to
+    `context_share` of `budget`), summary of older turns and as many recent turns
+    as fit in the remaining budget, newest kept first.
+    """
+    remaining = budget - estimate_tokens(system_prompt) - estimate_tokens(question)
+    context = _clip(conversation.get('recipe_context', ''), max(int(budget * context_share), 1))
+    preamble = f"Here are the recipes I suggested:\n\n{context}"
+    if conversation.get('summary'):
+        preamble += f"\n\nEarlier in this conversation:\n{conversation['summary']}"
+    remaining -= estimate_tokens(preamble)
+
+    recent = []
+    for turn in reversed(conversation.get('turns', [])):
+        cost = estimate_tokens(turn['q']) + estimate_tokens(turn['a'])
+        if cost > remaining:
+            break
+        recent.append(turn)
+        remaining -= cost
+    recent.reverse()
+
+    messages = [{'role': 'system', 'content': system_prompt},
+                {'role': 'user', 'content': preamble}]
+    for turn in recent:
+        messages.append({'role': 'user', 'content': turn['q']})
+        messages.append({'role': 'assistant', 'content': turn['a']})
+    messages.append({'role': 'user', 'content': f"User question: {question}"})
+    return messages
+
+
+def record_turn(conversation, question, answer, max_turns, usage=None):
+    """Append a turn, folding the oldest ones into the summary beyond `max_turns`,
+    and account the tokens the API reported for it.
+    """
+    turns = conversation.setdefault('turns', [])
+    turns.append({'q': question, 'a': answer})
+    while len(turns) > max_turns:
+        conversation['summary'] = _summarize(conversation.get('summary', ''), turns.pop(0))
+    chat_stats['turns'] += 1
+    if usage:
+        conversation['tokens_used'] = conversation.get('tokens_used', 0) + usage['total_tokens']
+        chat_stats['prompt_tokens'] += usage['prompt_tokens']
+        chat_stats['completion_tokens'] += usage['completion_tokens']
+    return conversation
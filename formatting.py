@@ -0,0 +1,103 @@
+"""Telegram text formatting helpers.
+
+`split_markdown` cuts long texts into chunks that fit a Telegram message
+without breaking legacy Markdown entities (*bold*, _italic_, `code`,
+```pre``` and [links](url)). It scans each chunk once, so splitting is linear
+in the length of the text.
+"""
+
+TELEGRAM_LIMIT = 4000
+
+
+def to_telegram_markdown(text):
+    """Map the model's Markdown-ish output onto Telegram's legacy Markdown."""
+    return text.replace('###', '🍳').replace('**', '*')
+
+
+def _safe_breaks(text, start, end, in_pre):
+    """Scan text[start:end] and return (last newline, last space) where no entity is
+    open, whether a ``` block is open at `end`, the last newline inside it, and the
+    start of an entity that is still open at `end` (-1 if none), where the scan stops.
+    An opener that is never closed is taken literally (e.g. a "* item" bullet or
+    "2*3 cups"), so it doesn't hide the break points after it."""
+    last_newline = last_space = last_pre_newline = -1
+    found = {}  # closing character -> its next index in text seen so far, -1 for none
+
+    def find(ch, i):
+        pos = found.get(ch)
+        if pos is None or -1 < pos < i:
+            pos = found[ch] = text.find(ch, i)
+        return pos
+
+    i = start
+    while i < end:
+        ch = text[i]
+        if in_pre:
+            if text.startswith('```', i):
+                in_pre = False
+                i += 3
+                continue
+            if ch == '\n':
+                last_pre_newline = i
+        elif ch == '\\':
+            i += 2
+            continue
+        elif text.startswith('```', i):
+            in_pre = True
+            i += 3
+            continue
+        elif ch in '*_`[':
+            close = find(']' if ch == '[' else ch, i + 1)
+            if ch == '[' and close != -1 and text.startswith('](', close):
+                close = find(')', close + 2)
+            if close >= end:
+                return last_newline, last_space, False, last_pre_newline, i
+            if close != -1:
+                i = close + 1  # no break inside the entity
+                continue
+        elif ch == '\n':
+            last_newline = i
+        elif ch == ' ':
+            last_space = i
+        i += 1
+    return last_newline, last_space, in_pre, last_pre_newline, -1
+
+
+def _next_chunk(text, pos, limit, in_pre):
+    """Return (chunk, next_pos, next_in_pre) for the chunk starting at `pos`.
+    Prefers a line break, then a space, outside any entity. Inside a ``` block it
+    closes the block at a line break and reopens it in the next chunk. Otherwise
+    it cuts before an entity that doesn't fit, or hard at `limit`.
+    """
+    prefix = '```\n' if in_pre else ''
+    budget = limit - len(prefix) - 4  # room to close a ``` block
+    if len(text) - pos <= limit - len(prefix):
+        return prefix + text[pos:], len(text), False
+    end = pos + budget
+    newline, space, open_pre, pre_newline, open_entity = _safe_breaks(text, pos, end, in_pre)
+    if newline > pos:
+        return prefix + text[pos:newline], newline + 1, False
+    if open_pre and pre_newline > pos:
+        return prefix + text[pos:pre_newline] + '\n```', pre_newline + 1, True
+    if space > pos:
+        return prefix + text[pos:space], space + 1, False
+    if open_entity > pos:
+        return prefix + text[pos:open_entity], open_entity, False
+    return prefix + text[pos:end], end, False
+
+
+def split_head(text, limit=TELEGRAM_LIMIT):
+    """Split off the first message-sized chunk of `text`. Returns (head, rest)."""
+    head, pos, in_pre = _next_chunk(text, 0, limit, False)
+    return head, ('```\n' if in_pre else '') + text[pos:]
+
+
+def split_markdown(text, limit=TELEGRAM_LIMIT):
+    """Split `text` into message-sized chunks on entity-safe boundaries."""
+    chunks = []
+    pos, in_pre = 0, False
+    while pos < len(text):
+        chunk, pos, in_pre = _next_chunk(text, pos, limit, in_pre)
+        if chunk.strip():
+            chunks.append(chunk)
+    return chunks
@@ -0,0 +1,69 @@
+"""Image helpers for the photo recipe flow.
+
+Pillow is optional: without it `perceptual_hash` returns None (only exact
+`file_unique_id` matches are cached) and images are sent to OpenAI unresized.
+"""
+import io
+
+import telemetry
+
+
+def pick_photo_size(sizes, max_side):
+    """Smallest Telegram PhotoSize covering `max_side` pixels on its long edge, else the largest."""
+    sizes = sorted(sizes, key=lambda s: s.width * s.height)
+    for size in sizes:
+        if max(size.width, size.height) >= max_side:
+            return size
+    return sizes[-1]
+
+
+def load_photo(data, max_side):
+    """Decode image bytes once for both the duplicate check and the vision request.
+    Returns (image downscaled to at most `max_side`, True if `data` can be sent as is,
+    perceptual hash); the image and hash are None without Pillow or for unreadable data.
+    Decoding is CPU-bound, so callers on the event loop run this in a thread.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return None, True, None
+    try:
+        img = Image.open(io.BytesIO(data))
+        as_is = max(img.size) <= max_side and img.format == 'JPEG'
+        img.draft('RGB', (max_side, max_side))  # JPEG: decode at a reduced scale when possible
+        img = img.convert('RGB')
+        img.thumbnail((max_side, max_side))
+    except Exception as e:
+        telemetry.log('image_decode_failed', level='warning', size=len(data), error=repr(e))
+        return None, True, None
+    return img, as_is, perceptual_hash(img)
+
+
+def prepare_for_vision(data, img, as_is, quality=85):
+    """JPEG bytes for OpenAI: the original `data` when it is a small enough JPEG (or
+    couldn't be decoded), else `img` (from `load_photo`) re-encoded.
+    """
+    if img is None or as_is:
+        return data
+    out = io.BytesIO()
+    img.save(out, 'JPEG', quality=quality, optimize=True)
+    return out.getvalue()
+
+
+def perceptual_hash(img):
+    """64-bit difference hash (dHash) of a decoded image, or None without one.
+    Visually identical images (re-encoded, resized, forwarded) hash to the same
+    or a nearby value, so duplicates can be found by Hamming distance.
+    """
+    if img is None:
+        return None
+    pixels = list(img.convert('L').resize((9, 8)).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
@@ -0,0 +1,392 @@
+"""Offline load test and benchmark against local stubs of Telegram and OpenAI.
+
+Starts `uvicorn main:app` with each requested worker count, pointed at a stub
+Bot API server (messages, getFile and photo downloads) and a stub OpenAI
+server (streamed and plain chat completions), both with configurable latency.
+Synthetic users walk through a script of text messages, photos and inline
+button callbacks; each user's updates are posted in order, each on a new
+connection as Telegram does, so with several workers a user's updates reach
+different workers.
+
+Reported per run:
+
+- webhook acknowledgement latency (p50/p99), measured by the load generator;
+- throughput: updates per second until the workers have processed every accepted update;
+- processing latency (p50/p99) per update, handler and external call, and
+  worker memory before and after the run, read from `/metrics` of every worker.
+
+    python loadtest.py --workers 1 2 4 --updates 2000 --users 100 --openai-latency 0.5
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+from router import encode_id
+
+BOT_TOKEN = '123456:LOADTEST'
+# One pass through the bot per synthetic user; ('photo',) and ('callback', data) are non-text updates
+SCRIPT = [
+    '/start',
+    '🤖 Cook companion AI',
+    ('photo',),
+    'Can I use butter instead of oil?',
+    'How long does it keep in the fridge?',
+    '🏠 Back to Home',
+    '📚 Find recipes by list',
+    ('callback', 'recipes_page_1'),
+    ('callback', 'r_{recipe}'),
+    'Tasty, thanks!',
+    ('callback', 'rc_{recipe}'),
+    '🔎 Search recipes',
+    '{ingredients}',
+]
+INGREDIENTS = ['eggs', 'milk', 'flour', 'tomato', 'pasta', 'garlic', 'onion', 'rice', 'chicken', 'beans',
+               'cheese', 'potato', 'carrot', 'spinach', 'butter', 'lemon', 'basil', 'mushroom', 'pepper', 'tofu']
+RECIPE_REPLY = ("### 🍳 Quick Tomato Pasta\n\n**Ingredients:**\n• 200 g pasta\n• 3 tomatoes\n• 2 cloves garlic\n\n"
+                "**Instructions:**\n1. Boil the pasta.\n2. Fry garlic, add chopped tomatoes.\n3. Toss and serve.\n\n") * 4
+
+
+def make_jpeg(seed, size=(1280, 960)):
+    from PIL import Image
+    rng = random.Random(seed)
+    small = Image.new('RGB', (16, 12))
+    small.putdata([(rng.randrange(256), rng.randrange(256), rng.randrange(256)) for _ in range(16 * 12)])
+    buf = io.BytesIO()
+    small.resize(size).save(buf, format='JPEG', quality=80)
+    return buf.getvalue()
+
+
+def make_stub_telegram(latency, photos):
+    """Answer Bot API calls with minimal successful results and serve photo downloads."""
+    counter = itertools.count(1)
+    stats = {'calls': 0}
+
+    async def handle(request):
+        method = request.match_info['method']
+        if latency:
+            await asyncio.sleep(latency)
+        stats['calls'] += 1
+        params = dict(request.query)
+        params.update(await request.post())
+        if method == 'getFile':
+            file_id = params.get('file_id', 'x')
+            return web.json_response({'ok': True, 'result': {
+                'file_id': file_id, 'file_unique_id': file_id, 'file_path': f'photos/{file_id}.jpg'}})
+        if method in ('answerCallbackQuery', 'setWebhook', 'deleteWebhook'):
+            return web.json_response({'ok': True, 'result': True})
+        return web.json_response({'ok': True, 'result': {
+            'message_id': next(counter), 'date': int(time.time()),
+            'chat': {'id': int(params.get('chat_id') or 1), 'type': 'private'}, 'text': params.get('text', 'ok'),
+        }})
+
+    async def download(request):
+        if latency:
+            await asyncio.sleep(latency)
+        stats['calls'] += 1
+        return web.Response(body=photos[hash(request.match_info['path']) % len(photos)], content_type='image/jpeg')
+
+    async def get_stats(request):
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_get('/_stats', get_stats)
+    app.router.add_route('*', '/file/bot{token}/{path:.*}', download)
+    app.router.add_route('*', '/bot{token}/{method}', handle)
+    app.router.add_route('*', '/', get_stats)
+    return app
+
+
+def make_stub_openai(latency):
+    """Chat completions: a fixed recipe, streamed in chunks or returned at once."""
+    usage = {'prompt_tokens': 300, 'completion_tokens': 250, 'total_tokens': 550}
+
+    async def completions(request):
+        body = await request.json()
+        created = int(time.time())
+        if not body.get('stream'):
+            await asyncio.sleep(latency)
+            return web.json_response({
+                'id': 'cmpl-load', 'object': 'chat.completion', 'created': created, 'model': body['model'],
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': RECIPE_REPLY}}],
+                'usage': usage,
+            })
+        resp = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await resp.prepare(request)
+        await asyncio.sleep(latency / 2)  # time to first token
+        pieces = re.findall(r'.{1,40}', RECIPE_REPLY, re.S)
+        for piece in pieces:
+            chunk = {'id': 'cmpl-load', 'object': 'chat.completion.chunk', 'created': created, 'model': body['model'],
+                     'choices': [{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}]}
+            await resp.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+            await asyncio.sleep(latency / 2 / len(pieces))
+        tail = {'id': 'cmpl-load', 'object': 'chat.completion.chunk', 'created': created, 'model': body['model'],
+                'choices': [], 'usage': usage}
+        await resp.write(f'data: {json.dumps(tail)}\n\ndata: [DONE]\n\n'.encode())
+        return resp
+
+    app = web.Application()
+    app.router.add_post('/v1/chat/completions', completions)
+    return app
+
+
+def serve_stubs(telegram_port, openai_port, args):
+    # separate process so the stubs don't compete with the load generator's event loop
+    async def run():
+        photos = [make_jpeg(i) for i in range(args.photo_variety)]
+        for app, port in ((make_stub_telegram(args.latency, photos), telegram_port),
+                          (make_stub_openai(args.openai_latency), openai_port)):
+            runner = web.AppRunner(app)
+            await runner.setup()
+            await web.TCPSite(runner, '127.0.0.1', port).start()
+        await asyncio.Event().wait()
+    asyncio.run(run())
+
+
+def seed_recipes(data_dir, count):
+    """Legacy receipts.json in DATA_DIR; the bot imports it into SQLite on start."""
+    rng = random.Random(0)
+    receipts = []
+    for i in range(count):
+        items = rng.sample(INGREDIENTS, 5)
+        receipts.append({'added_by': 0, 'title': f'{items[0].title()} and {items[1]} #{i}',
+                         'text': 'Ingredients: ' + ', '.join(items) + '\n\nMix everything and cook for 20 minutes.'})
+    with open(os.path.join(data_dir, 'receipts.json'), 'w', encoding='utf-8') as f:
+        json.dump(receipts, f)
+
+
+def make_update(update_id, user_id, step, rng, recipes):
+    """Telegram Update JSON for one SCRIPT step."""
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+    chat = {'id': user_id, 'type': 'private'}
+    message = {'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'from': user}
+    if isinstance(step, str):
+        message['text'] = step.format(ingredients=', '.join(rng.sample(INGREDIENTS, 3)))
+        return {'update_id': update_id, 'message': message}
+    if step[0] == 'photo':
+        file_id = f'photo-{update_id}'
+        message['photo'] = [{'file_id': f'{file_id}-{w}', 'file_unique_id': f'{file_id}-{w}', 'width': w, 'height': w * 3 // 4}
+                            for w in (320, 800, 1280)]
+        return {'update_id': update_id, 'message': message}
+    data = step[1].format(recipe=encode_id(rng.randrange(recipes) + 1))  # seeded ids start at 1
+    return {'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'from': user, 'chat_instance': str(user_id), 'data': data,
+        'message': dict(message, text='menu', **{'from': {'id': 1, 'is_bot': True, 'first_name': 'bot'}}),
+    }}
+
+
+def parse_metrics(text):
+    """{(name, labels): value} from Prometheus text format."""
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        match = re.match(r'([a-zA-Z_:][\w:]*)(\{(.*)\})? (\S+)$', line)
+        if match:
+            labels = tuple(sorted(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', match.group(3) or '')))
+            samples[(match.group(1), labels)] = float(match.group(4))
+    return samples
+
+
+async def scrape_workers(port, workers, attempts=200):
+    """Scrape /metrics until every worker has answered once. Returns one sample dict per worker."""
+    seen = {}
+    connector = aiohttp.TCPConnector(force_close=True)  # new connection each time, so other workers get a turn
+    async with aiohttp.ClientSession(connector=connector) as session:
+        for _ in range(attempts):
+            async with session.get(f'http://127.0.0.1:{port}/metrics') as resp:
+                samples = parse_metrics(await resp.text())
+            seen[samples.get(('process_start_time_seconds', ()))] = samples
+            if len(seen) >= workers:
+                break
+    return list(seen.values())
+
+
+def merged_histogram(per_worker, name):
+    """{labels without le: {le: count}} summed over workers."""
+    merged = {}
+    for samples in per_worker:
+        for (metric, labels), value in samples.items():
+            if metric != f'{name}_bucket':
+                continue
+            le = dict(labels)['le']
+            key = tuple(kv for kv in labels if kv[0] != 'le')
+            bucket = merged.setdefault(key, {})
+            bucket[le] = bucket.get(le, 0) + value
+    return merged
+
+
+def quantile(buckets, q):
+    """Estimate a quantile from cumulative buckets, interpolating linearly inside a bucket."""
+    bounds = sorted((float(le), count) for le, count in buckets.items())
+    total = bounds[-1][1]
+    if not total:
+        return 0.0
+    rank = q * total
+    lower, below = 0.0, 0
+    for bound, count in bounds:
+        if count >= rank:
+            if bound == float('inf'):
+                return lower
+            return lower + (bound - lower) * (rank - below) / max(count - below, 1)
+        lower, below = bound, count
+    return lower
+
+
+def report_histograms(per_worker, name, label):
+    for key, buckets in sorted(merged_histogram(per_worker, name).items()):
+        count = buckets.get('+Inf', 0)
+        if not count:
+            continue
+        what = ' '.join(dict(key).get(name, '') for name in label)
+        print(f'    {name:<22} {what:<26} n={int(count):<6} p50 {quantile(buckets, 0.5) * 1000:8.1f} ms'
+              f'   p99 {quantile(buckets, 0.99) * 1000:8.1f} ms')
+
+
+def memory_mb(per_worker):
+    return sum(s.get(('process_resident_memory_bytes', ()), 0) for s in per_worker) / 2 ** 20
+
+
+async def wait_until_up(session, url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(url) as resp:
+                if resp.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f'{url} did not come up within {timeout}s')
+
+
+def handled(per_worker):
+    """Updates processed or failed, summed over workers."""
+    return sum(s.get(('updates', (('result', result),)), 0) for s in per_worker for result in ('processed', 'errors'))
+
+
+async def wait_until_handled(port, workers, count, timeout=300):
+    """Wait until the workers have processed (or failed) `count` updates. Returns the time they had."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        per_worker = await scrape_workers(port, workers)
+        if handled(per_worker) >= count:
+            return time.time()
+        await asyncio.sleep(0.1)
+    raise RuntimeError(f'bot handled {handled(per_worker):.0f} of {count} updates in {timeout}s')
+
+
+async def run_once(workers, args):
+    data_dir = tempfile.mkdtemp(prefix='cooking-bot-load-')
+    seed_recipes(data_dir, args.recipes)
+    env = dict(os.environ,
+               BOT_TOKEN=BOT_TOKEN,
+               WEBHOOK_URL=f'http://127.0.0.1:{args.port}',
+               TELEGRAM_API_URL=f'http://127.0.0.1:{args.stub_port}',
+               OPENAI_API_KEY='sk-loadtest',
+               OPENAI_BASE_URL=f'http://127.0.0.1:{args.openai_port}/v1',
+               DATA_DIR=data_dir,
+               STATE_BACKEND='sqlite',
+               WEB_CONCURRENCY=str(workers))
+    if not args.pace:
+        # measure the bot, not the per-user and Telegram flood limits
+        env.update(USER_RATE_LIMIT='1000000', USER_RATE_BURST='1000000',
+                   TELEGRAM_GLOBAL_RATE='1000000', TELEGRAM_CHAT_RATE='1000000')
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(args.port),
+         '--workers', str(workers), '--log-level', 'warning'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        stdout=None if args.verbose else subprocess.DEVNULL)
+    try:
+        # a new connection per update: a kept-alive one would pin each user to a single worker
+        connector = aiohttp.TCPConnector(force_close=True)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await wait_until_up(session, f'http://127.0.0.1:{args.port}/')
+            before = await scrape_workers(args.port, workers)
+            update_ids = itertools.count(1)
+            remaining = [args.updates]
+            acks = []
+            statuses = {}
+
+            async def user(user_id):
+                rng = random.Random(user_id)
+                for step in itertools.cycle(SCRIPT):
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+                    update = make_update(next(update_ids), user_id, step, rng, args.recipes)
+                    started = time.perf_counter()
+                    async with session.post(f'http://127.0.0.1:{args.port}/webhook', json=update) as resp:
+                        await resp.read()
+                    acks.append(time.perf_counter() - started)
+                    statuses[resp.status] = statuses.get(resp.status, 0) + 1
+
+            started = time.time()
+            await asyncio.gather(*(user(1000 + i) for i in range(args.users)))
+            posted = time.time() - started
+        accepted = statuses.get(200, 0) + handled(before)
+        finished = await wait_until_handled(args.port, workers, accepted)
+        elapsed = max(finished - started, posted)
+        after = await scrape_workers(args.port, workers)
+
+        acks.sort()
+        p50 = acks[len(acks) // 2] * 1000
+        p99 = acks[max(int(len(acks) * 0.99) - 1, 0)] * 1000
+        print(f'workers={workers:<3} {args.updates / elapsed:8.1f} updates/s   '
+              f'webhook ack p50 {p50:6.1f} ms  p99 {p99:6.1f} ms   HTTP {dict(sorted(statuses.items()))}')
+        report_histograms(after, 'update_seconds', ('type',))
+        report_histograms(after, 'handler_seconds', ('handler',))
+        report_histograms(after, 'route_seconds', ('route',))
+        report_histograms(after, 'external_call_seconds', ('service', 'op'))
+        report_histograms(after, 'storage_seconds', ('op',))
+        print(f'    memory {memory_mb(before):.1f} MB -> {memory_mb(after):.1f} MB '
+              f'({memory_mb(after) - memory_mb(before):+.1f} MB over {workers} worker(s))')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=100, help='concurrent synthetic users')
+    parser.add_argument('--recipes', type=int, default=300, help='recipes seeded into the store')
+    parser.add_argument('--latency', type=float, default=0.0, help='stub Telegram latency in seconds')
+    parser.add_argument('--openai-latency', type=float, default=0.5, help='stub OpenAI time per completion in seconds')
+    parser.add_argument('--photo-variety', type=int, default=50, help='distinct images served for photo downloads')
+    parser.add_argument('--pace', action='store_true', help='keep the per-user and Telegram rate limits')
+    parser.add_argument('--verbose', action='store_true', help="show the bot's log output")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--stub-port', type=int, default=8766)
+    parser.add_argument('--openai-port', type=int, default=8767)
+    args = parser.parse_args()
+
+    stubs = multiprocessing.Process(target=serve_stubs, args=(args.stub_port, args.openai_port, args), daemon=True)
+    stubs.start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            await wait_until_up(session, f'http://127.0.0.1:{args.stub_port}/')
+        print(f'{os.cpu_count()} CPUs, {args.updates} updates from {args.users} users, '
+              f'Telegram latency {args.latency * 1000:.0f} ms, OpenAI latency {args.openai_latency * 1000:.0f} ms')
+        for workers in args.workers:
+            await run_once(workers, args)
+    finally:
+        stubs.terminate()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,6 +1,11 @@
+import time
+_import_started = time.perf_counter()
+
 from urllib import request
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import PlainTextResponse
 import asyncio
+import importlib
 import os
 
 # CRITICAL: Clear ALL proxy env vars before any other imports
@@ -8,72 +13,163 @@ import os
 for var in ['HTTP_PROXY', 'HTTPS_PROXY', 'http_proxy', 'https_proxy', 'ALL_PROXY', 'all_proxy', 'NO_PROXY', 'no_proxy']:
     os.environ.pop(var, None)
 
-# Patch requests.Session to not use proxies by default
-import requests
-_original_session = requests.Session
+from config import (WEBHOOK_URL, OPENAI_API_KEY, STATE_BACKEND, WEB_CONCURRENCY, UPDATE_WORKERS, UPDATE_QUEUE_SIZE,
+                    OPENAI_MAX_CONCURRENCY)
+from bot import (bot, types, handler_failures, get_openai_client, close_openai_client, send_scheduler, user_states,
+                 recipe_cache, photo_cache, photo_hash_cache)
+from search import build_index
+from storage import (acquire_lease, get_receipts, run_io, flush as flush_storage, pending_writes,
+                     cache_stats as storage_cache_stats)
+from updates import UpdateDispatcher
+from ratelimit import openai_semaphore
+import pregen
+import telemetry
 
-class PatchedSession(requests.Session):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.trust_env = False  # Disable env proxy detection
+app = FastAPI()
 
-requests.Session = PatchedSession
 
-# Also patch OpenAI to remove proxies kwarg if passed
-def patch_openai():
-    """Monkeypatch OpenAI client to reject proxies kwarg"""
-    try:
-        from openai import OpenAI as OriginalOpenAI
-        
-        class PatchedOpenAI(OriginalOpenAI):
-            def __init__(self, *args, **kwargs):
-                # Remove proxies kwarg if present
-                kwargs.pop('proxies', None)
-                super().__init__(*args, **kwargs)
-        
-        # Replace in sys.modules
-        import openai
-        openai.OpenAI = PatchedOpenAI
-    except:
-        pass
-
-patch_openai()
-
-from config import WEBHOOK_URL
-from bot import bot, types
+async def process_update(data):
+    update_id = data.get('update_id')
+    kind = next((k for k in data if k != 'update_id'), 'unknown')
+    telemetry.set_trace_id(f'u{update_id}')
+    telemetry.inc('telegram_updates_total', type=kind)
+    failures = []
+    handler_failures.set(failures)
+    with telemetry.timed('update_seconds', type=kind):
+        await bot.process_new_updates([types.Update.de_json(data)])
+        if failures:
+            raise failures[0]  # counted as a failed update by the dispatcher
 
-app = FastAPI()
+dispatcher = None
+_background = set()
+# seconds spent per startup phase: import, storage, search_index, openai, openai_client, caches
+startup_phases = {}
+
+
+def register_metrics():
+    """Gauges read on every /metrics scrape."""
+    telemetry.describe('handler_seconds', 'Time spent in bot handlers')
+    telemetry.describe('route_seconds', 'Time spent in each text and callback route')
+    telemetry.describe('update_seconds', 'Time to process one Telegram update')
+    telemetry.describe('external_call_seconds', 'Latency of calls to OpenAI and Telegram')
+    telemetry.describe('storage_seconds', 'Latency of storage operations')
+    telemetry.describe('openai_tokens_total', 'Tokens reported by OpenAI')
+    telemetry.describe('pregen_seconds', 'Duration of background pre-generation runs')
+    telemetry.describe('pregen_lists_total', 'Ingredient lists submitted or generated in the background')
+    telemetry.gauge('startup_phase_seconds', lambda: [({'phase': k}, v) for k, v in startup_phases.items()],
+                    'Time spent in each startup phase')
+    telemetry.gauge('update_queue_depth', dispatcher.depth, 'Updates waiting for a consumer')
+    telemetry.gauge('updates', lambda: [({'result': k}, v) for k, v in dispatcher.stats.items()],
+                    'Webhook updates by outcome since start')
+    telemetry.gauge('telegram_send_pending', send_scheduler.queue_depth, 'Outgoing Telegram calls waiting or in flight')
+    telemetry.gauge('telegram_send', lambda: [({'result': k}, v) for k, v in send_scheduler.stats.items()],
+                    'Outgoing Telegram calls by outcome since start')
+    telemetry.gauge('openai_active', lambda: openai_semaphore.active, 'OpenAI calls in flight')
+    telemetry.gauge('openai_waiting', openai_semaphore.waiting, 'OpenAI calls waiting for a slot')
+    telemetry.gauge('user_states', lambda: len(user_states), 'Users with conversation state')
+    telemetry.gauge('storage_pending_writes', pending_writes, 'Deferred storage writes not committed yet')
+    caches = {'recipes': recipe_cache, 'photos': photo_cache, 'photo_hashes': photo_hash_cache}
+
+    def cache_series(field):
+        stats = {name: c.stats() for name, c in caches.items()}
+        stats['storage_reads'] = dict(storage_cache_stats)
+        return [({'cache': name}, s[field]) for name, s in stats.items()]
+    telemetry.gauge('cache_hits', lambda: cache_series('hits'), 'Cache hits since start')
+    telemetry.gauge('cache_misses', lambda: cache_series('misses'), 'Cache misses since start')
 
 @app.get("/")
 async def root():
     """Health check endpoint for Render"""
-    return {"status": "ok", "service": "cooking-bot"}
+    return {"status": "ok", "service": "cooking-bot", "warm": 'caches' in startup_phases}
 
 @app.on_event('startup')
 async def start_app():
+    global dispatcher
+    startup_phases['import'] = time.perf_counter() - _import_started
+    # enough consumers for every OpenAI slot to be in use with as many left for quick updates
+    workers = max(UPDATE_WORKERS, 2 * OPENAI_MAX_CONCURRENCY)
+    dispatcher = UpdateDispatcher(process_update, workers, UPDATE_QUEUE_SIZE,
+                                  shared_dedup=WEB_CONCURRENCY > 1, shared_order=WEB_CONCURRENCY > 1)
+    dispatcher.start()
+    register_metrics()
+    if WEB_CONCURRENCY > 1 and STATE_BACKEND == 'memory':
+        telemetry.log('config_warning', level='warning', workers=WEB_CONCURRENCY, state_backend=STATE_BACKEND,
+                      message='multi-step flows break with in-memory state across workers; use STATE_BACKEND=sqlite')
+    # Everything else runs once the server is accepting requests, so the health check answers right away
+    for job in (register_webhook(), warm_up(), pregen.run(dispatcher)):
+        task = asyncio.create_task(job)
+        _background.add(task)
+        task.add_done_callback(_background.discard)
+
+
+async def register_webhook():
+    # With several workers only one of them registers the webhook
+    if not await run_io(acquire_lease, 'set_webhook', 30):
+        return
     try:
         # Try to set webhook with retry logic for rate limiting
         max_retries = 3
         for attempt in range(max_retries):
             try:
                 await bot.set_webhook(WEBHOOK_URL+'/webhook')
-                print(f"✅ Webhook set successfully: {WEBHOOK_URL}/webhook")
+                telemetry.log('webhook_set', url=f'{WEBHOOK_URL}/webhook')
                 break
             except Exception as e:
                 if "429" in str(e) and attempt < max_retries - 1:
                     wait_time = 2 ** attempt  # exponential backoff: 1s, 2s, 4s
-                    print(f"⚠️  Rate limited. Retrying in {wait_time}s...")
+                    telemetry.log('webhook_rate_limited', level='warning', attempt=attempt + 1, retry_in=wait_time)
                     await asyncio.sleep(wait_time)
                 elif attempt == max_retries - 1:
-                    print(f"⚠️  Could not set webhook (rate limited). Webhook may already be set: {e}")
+                    telemetry.log('webhook_failed', level='warning', attempts=max_retries, error=repr(e),
+                                  message='webhook may already be set')
                 else:
                     raise
     except Exception as e:
-        print(f"⚠️  Webhook setup failed: {e}")
+        telemetry.log('webhook_failed', level='error', error=repr(e))
+
+
+async def warm_up():
+    """Load what the first requests would otherwise pay for. Blocking work runs in a thread."""
+    phases = [('storage', lambda: run_io(get_receipts)),
+              ('search_index', lambda: asyncio.to_thread(build_index))]
+    if OPENAI_API_KEY:
+        # importing openai is slow; done here so the first AI request doesn't pay for it
+        phases.append(('openai', lambda: asyncio.to_thread(importlib.import_module, 'openai')))
+    for name, run in phases:
+        started = time.perf_counter()
+        try:
+            await run()
+        except Exception as e:
+            telemetry.log('warm_up_failed', level='error', phase=name, error=repr(e))
+        startup_phases[name] = time.perf_counter() - started
+    # these touch state shared with request handlers, so they run on the event loop
+    started = time.perf_counter()
+    if OPENAI_API_KEY:
+        get_openai_client()
+    startup_phases['openai_client'] = time.perf_counter() - started
+    started = time.perf_counter()
+    for cache in (recipe_cache, photo_cache, photo_hash_cache):
+        cache.keys()  # loads persisted entries
+    startup_phases['caches'] = time.perf_counter() - started
+    telemetry.log('startup', **{f'{k}_seconds': round(v, 3) for k, v in startup_phases.items()})
+
+@app.on_event('shutdown')
+async def stop_app():
+    for task in list(_background):
+        task.cancel()
+    await dispatcher.stop()
+    await run_io(flush_storage)
+    await close_openai_client()
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint (numbers of the worker that answers)"""
+    return PlainTextResponse(telemetry.render(), media_type='text/plain; version=0.0.4')
 
 @app.post("/webhook")
 async def handle_webhook(request: Request):
     json_data = await request.json()
-    update = types.Update.de_json(json_data)
-    await bot.process_new_updates([update])
+    # Processed in the background so Telegram isn't kept waiting (and doesn't retry) during OpenAI calls
+    if await dispatcher.submit(json_data) == 'full':
+        return Response("Busy", status_code=503)
     return "OK"
\ No newline at end of file
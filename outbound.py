@@ -0,0 +1,109 @@
+"""Pacing of outbound Telegram calls.
+
+Telegram allows roughly 30 messages per second per bot, about one per second
+in a private chat (short bursts are tolerated) and 20 per minute in a group.
+`SendScheduler` reserves a slot against both the global and the per-chat
+budget before each call, keeps each chat's calls in FIFO order, and on a 429
+waits the `retry_after` Telegram asks for and retries.
+
+With several worker processes (`workers` > 1) each one paces at its share of
+the global rate, and per-chat budgets are kept in the shared database
+(`storage.reserve_pace`), since one chat's updates can reach any worker.
+"""
+import asyncio
+import time
+
+from telebot.asyncio_helper import ApiTelegramException
+
+from storage import reserve_pace, run_io
+import telemetry
+
+
+class _Pace:
+    """Generic cell rate algorithm: `rate` calls per second with bursts of `burst`."""
+
+    def __init__(self, rate, burst):
+        self.interval = 1.0 / rate
+        self.tolerance = self.interval * (burst - 1)
+        self.tat = 0.0  # theoretical arrival time of the next call
+
+    def reserve(self, now):
+        """Book the next slot and return how long to wait for it."""
+        tat = max(self.tat, now)
+        delay = max(0.0, tat - self.tolerance - now)
+        self.tat = tat + self.interval
+        return delay
+
+    def hold_until(self, when):
+        self.tat = max(self.tat, when)
+
+
+class SendScheduler:
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, group_per_minute=20, max_retries=3, workers=1):
+        self.max_retries = max_retries
+        self.shared = workers > 1  # per-chat budgets live in the shared database
+        share = global_rate / workers
+        self._global = _Pace(share, max(share, 1))
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._group_rate = group_per_minute / 60.0
+        self._chats = {}  # chat_id -> [_Pace, asyncio.Lock, users]
+        self.pending = 0
+        self.stats = {'sent': 0, 'delayed': 0, 'retries_429': 0, 'failed': 0}
+
+    def _chat(self, chat_id):
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            is_group = isinstance(chat_id, int) and chat_id < 0
+            pace = _Pace(self._group_rate, 1) if is_group else _Pace(self._chat_rate, self._chat_burst)
+            entry = self._chats[chat_id] = [pace, asyncio.Lock(), 0]
+        return entry
+
+    async def _wait_turn(self, chat_id, pace):
+        if self.shared:
+            chat_delay = await run_io(reserve_pace, f'chat:{chat_id}', pace.interval, pace.tolerance)
+        else:
+            chat_delay = pace.reserve(time.monotonic())
+        delay = max(chat_delay, self._global.reserve(time.monotonic()))
+        if delay:
+            self.stats['delayed'] += 1
+            await asyncio.sleep(delay)
+
+    async def run(self, chat_id, make_call):
+        """Await `make_call()` once the chat and global budgets allow it."""
+        entry = self._chat(chat_id)
+        entry[2] += 1
+        self.pending += 1
+        try:
+            async with entry[1]:
+                for attempt in range(self.max_retries + 1):
+                    await self._wait_turn(chat_id, entry[0])
+                    try:
+                        with telemetry.timed('external_call_seconds', service='telegram', op='send'):
+                            result = await make_call()
+                        self.stats['sent'] += 1
+                        return result
+                    except ApiTelegramException as e:
+                        if e.error_code != 429 or attempt == self.max_retries:
+                            self.stats['failed'] += 1
+                            raise
+                        retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                        self.stats['retries_429'] += 1
+                        telemetry.log('telegram_flood_limit', level='warning', chat_id=chat_id, retry_after=retry_after)
+                        entry[0].hold_until(time.monotonic() + retry_after)
+                        if self.shared:
+                            await run_io(reserve_pace, f'chat:{chat_id}', entry[0].interval, entry[0].tolerance,
+                                         time.time() + retry_after)
+        finally:
+            self.pending -= 1
+            entry[2] -= 1
+            if len(self._chats) > 10000:
+                self._prune()
+
+    def _prune(self):
+        # idle chats whose budget has fully recovered carry no state worth keeping
+        now = time.monotonic()
+        self._chats = {c: e for c, e in self._chats.items() if e[2] or e[0].tat > now}
+
+    def queue_depth(self):
+        return self.pending
@@ -0,0 +1,163 @@
+"""Background pre-generation of recipes for popular ingredient lists.
+
+Every text ingredient request is counted in storage (`record_ingredient_request`).
+Every PREGEN_INTERVAL seconds one worker (holding the 'pregen' lease) picks the
+most requested lists whose answer is missing from `recipe_cache` or about to
+expire and generates it ahead of time, so those requests are answered from the
+cache without waiting for OpenAI.
+
+With PREGEN_MODE=batch the lists are sent through the OpenAI Batch API, which is
+billed at half price and completes within 24 hours; the pending batch is kept
+in the `kv_cache` table and collected on a later run. With PREGEN_MODE=direct
+they are generated one at a time with regular calls, only while no user
+request is waiting for or holding an OpenAI slot.
+"""
+import asyncio
+import json
+import time
+
+from config import (OPENAI_API_KEY, RECIPE_CACHE_TTL, PREGEN_MODE, PREGEN_INTERVAL, PREGEN_BATCH_SIZE,
+                    PREGEN_MIN_REQUESTS)
+from bot import get_openai_client, complete, ingredients_cache_key, ingredients_request, recipe_cache
+from ratelimit import openai_semaphore, background_slot
+from storage import (acquire_lease, kv_get, kv_set, kv_delete, popular_ingredient_requests,
+                     prune_ingredient_requests, run_io)
+import telemetry
+
+BATCH_KEY = ('pregen', 'batch')  # kv_cache entry holding the batch in progress
+BATCH_FAILED = ('failed', 'expired', 'cancelled')
+REFRESH_BEFORE = RECIPE_CACHE_TTL / 4  # regenerate answers expiring sooner than this
+FORGET_AFTER = 30 * 86400  # drop lists requested once and not seen for this long
+
+
+def _idle(dispatcher):
+    return dispatcher.depth() == 0 and openai_semaphore.active == 0 and openai_semaphore.waiting() == 0
+
+
+def _due():
+    """Up to PREGEN_BATCH_SIZE of the most popular lists whose cached answer is missing
+    or expiring, as [(key, ingredients)]. Lists with a fresh answer are skipped, so
+    less popular ones get their turn once the top ones are cached. Queries storage
+    once per row, so it is called through `run_io`.
+    """
+    due = []
+    offset, page = 0, PREGEN_BATCH_SIZE * 4
+    while len(due) < PREGEN_BATCH_SIZE:
+        rows = popular_ingredient_requests(PREGEN_MIN_REQUESTS, page, offset)
+        for _, ingredients, _ in rows:
+            key = ingredients_cache_key(ingredients)  # rows counted under an older key format still map
+            entry = recipe_cache.peek(key)
+            if (entry is None or entry[0] - time.time() < REFRESH_BEFORE) and key not in dict(due):
+                due.append((key, ingredients))
+        if len(rows) < page:
+            break
+        offset += page
+    return due[:PREGEN_BATCH_SIZE]
+
+
+async def _generate_direct(dispatcher):
+    done = 0
+    for key, ingredients in await run_io(_due):
+        if not _idle(dispatcher):
+            break
+        async with background_slot():
+            text, ok = await complete('', op='pregen', **ingredients_request(ingredients))
+        if ok:
+            recipe_cache.set(key, text)
+            done += 1
+    return done
+
+
+async def _submit_batch():
+    due = await run_io(_due)
+    if not due:
+        return 0
+    client = get_openai_client()
+    keys = {}
+    lines = []
+    for i, (key, ingredients) in enumerate(due):
+        custom_id = f'pregen-{i}'
+        keys[custom_id] = key
+        lines.append(json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': '/v1/chat/completions',
+                                 'body': ingredients_request(ingredients)}, ensure_ascii=False))
+    with telemetry.timed('external_call_seconds', service='openai', op='pregen_submit'):
+        upload = await client.files.create(file=('pregen.jsonl', '\n'.join(lines).encode()), purpose='batch')
+        batch = await client.batches.create(input_file_id=upload.id, endpoint='/v1/chat/completions',
+                                            completion_window='24h')
+    await run_io(kv_set, *BATCH_KEY, {'id': batch.id, 'keys': keys}, time.time() + 2 * 86400)
+    telemetry.log('pregen_submitted', batch=batch.id, lists=len(keys))
+    return len(keys)
+
+
+def _store_result(pending, result):
+    """Cache the answer in one line of a batch's output. Returns 1 if one was stored, else 0."""
+    key = pending['keys'].get(result.get('custom_id'))
+    response = result.get('response') or {}
+    if key is None or response.get('status_code') != 200:
+        return 0
+    body = response['body']
+    usage = body.get('usage')
+    if usage:
+        telemetry.inc('openai_tokens_total', usage['prompt_tokens'], op='pregen', kind='prompt')
+        telemetry.inc('openai_tokens_total', usage['completion_tokens'], op='pregen', kind='completion')
+    text = (body['choices'][0]['message']['content'] or '').strip()
+    if not text:
+        return 0
+    recipe_cache.set(key, text)
+    return 1
+
+
+async def _collect_batch(pending):
+    """Store the answers of a finished batch. Returns False while it is still running."""
+    client = get_openai_client()
+    with telemetry.timed('external_call_seconds', service='openai', op='pregen_poll'):
+        batch = await client.batches.retrieve(pending['id'])
+    if batch.status in BATCH_FAILED:
+        telemetry.log('pregen_batch_failed', level='error', batch=batch.id, status=batch.status)
+        await run_io(kv_delete, *BATCH_KEY)
+        return True
+    if batch.status != 'completed':
+        return False
+    stored = 0
+    if batch.output_file_id:
+        with telemetry.timed('external_call_seconds', service='openai', op='pregen_download'):
+            output = await client.files.content(batch.output_file_id)
+        for n, line in enumerate(output.text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                stored += _store_result(pending, json.loads(line))
+            except Exception as e:
+                # a bad line must not keep the batch pending, or every later run would fail on it again
+                telemetry.log('pregen_bad_result', level='warning', batch=batch.id, line=n, error=repr(e))
+    await run_io(kv_delete, *BATCH_KEY)
+    telemetry.log('pregen_collected', batch=batch.id, lists=len(pending['keys']), stored=stored)
+    return True
+
+
+async def run_once(dispatcher):
+    """One pre-generation pass; returns the number of lists submitted or generated."""
+    await run_io(prune_ingredient_requests, time.time() - FORGET_AFTER)
+    if PREGEN_MODE == 'direct':
+        return await _generate_direct(dispatcher)
+    entry = await run_io(kv_get, *BATCH_KEY)
+    if entry is not None and not await _collect_batch(entry[1]):
+        return 0
+    return await _submit_batch()
+
+
+async def run(dispatcher):
+    """Run `run_once` every PREGEN_INTERVAL seconds in whichever worker holds the lease."""
+    if PREGEN_MODE not in ('batch', 'direct') or not OPENAI_API_KEY:
+        return
+    while True:
+        await asyncio.sleep(PREGEN_INTERVAL)
+        if not _idle(dispatcher) or not await run_io(acquire_lease, 'pregen', PREGEN_INTERVAL - 1):
+            continue
+        try:
+            with telemetry.timed('pregen_seconds', mode=PREGEN_MODE):
+                count = await run_once(dispatcher)
+            if count:
+                telemetry.inc('pregen_lists_total', count, mode=PREGEN_MODE)
+        except Exception as e:
+            telemetry.log('pregen_failed', level='error', mode=PREGEN_MODE, error=repr(e))
@@ -0,0 +1,158 @@
+"""Rate limiting and concurrency control for OpenAI calls.
+
+- `TokenBucket` limits how often each user may start an AI request.
+- `FairSemaphore` caps concurrent OpenAI calls process-wide; waiting requests
+  are served round-robin per user so one busy user can't starve the others.
+
+With several worker processes the per-user buckets are kept in the shared
+database (`SharedTokenBucket`), and each worker gets an equal share of the
+concurrency and queue limits, so the configured limits hold for the whole bot.
+
+`openai_slot(uid)` combines both and raises `RateLimited` with a suggested
+wait when the user should be told to try again later. Retries with backoff on
+429s are done by the OpenAI SDK itself (see OPENAI_MAX_RETRIES).
+"""
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from config import USER_RATE_LIMIT, USER_RATE_BURST, OPENAI_MAX_CONCURRENCY, OPENAI_MAX_QUEUE, WEB_CONCURRENCY
+from storage import run_io, take_token
+import telemetry
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after, reason):
+        super().__init__(reason)
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.reason = reason  # 'user' or 'busy'
+
+    def user_message(self):
+        if self.reason == 'user':
+            return f"⏳ You're sending requests too quickly. Please try again in {self.retry_after} s."
+        return f"🔥 I'm busy cooking for lots of people right now. Please try again in {self.retry_after} s."
+
+
+class TokenBucket:
+    """Per-user buckets holding up to `burst` tokens, refilled at `rate_per_minute`."""
+
+    def __init__(self, rate_per_minute, burst, max_users=10000):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_users = max_users
+        self._buckets = {}  # uid -> (tokens, updated_at)
+
+    async def take(self, uid):
+        """Take one token. Returns 0 on success, else seconds until a token is available."""
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(uid, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[uid] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self._buckets[uid] = (tokens - 1, now)
+        if len(self._buckets) > self.max_users:
+            self._prune(now)
+        return 0
+
+    def _prune(self, now):
+        # buckets that have refilled completely carry no information
+        full_after = self.burst / self.rate
+        self._buckets = {u: (t, at) for u, (t, at) in self._buckets.items() if now - at < full_after}
+
+
+class SharedTokenBucket:
+    """`TokenBucket` whose state lives in the shared database, for several workers."""
+
+    def __init__(self, rate_per_minute, burst):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+
+    async def take(self, uid):
+        return await run_io(take_token, f'user:{uid}', self.rate, self.burst)
+
+
+class FairSemaphore:
+    """Semaphore whose waiters are woken round-robin across users."""
+
+    def __init__(self, limit, max_waiting):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.active = 0
+        self._waiters = OrderedDict()  # uid -> deque of futures
+
+    def waiting(self):
+        return sum(len(q) for q in self._waiters.values())
+
+    async def acquire(self, uid):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        if self.waiting() >= self.max_waiting:
+            raise RateLimited(5, 'busy')
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(uid, deque()).append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            queue = self._waiters.get(uid)
+            if queue and fut in queue:
+                queue.remove(fut)
+                if not queue:
+                    del self._waiters[uid]
+            elif fut.done() and not fut.cancelled():
+                self.release()  # the slot was handed to us just before cancellation
+            raise
+
+    def release(self):
+        # Hand the slot straight to the next user in line, if any
+        while self._waiters:
+            uid, queue = next(iter(self._waiters.items()))
+            fut = queue.popleft()
+            if queue:
+                self._waiters.move_to_end(uid)
+            else:
+                del self._waiters[uid]
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.active -= 1
+
+
+if WEB_CONCURRENCY > 1:
+    user_limiter = SharedTokenBucket(USER_RATE_LIMIT, USER_RATE_BURST)
+else:
+    user_limiter = TokenBucket(USER_RATE_LIMIT, USER_RATE_BURST)
+# each worker's share of the bot-wide limits
+openai_semaphore = FairSemaphore(max(1, OPENAI_MAX_CONCURRENCY // WEB_CONCURRENCY),
+                                 max(1, OPENAI_MAX_QUEUE // WEB_CONCURRENCY))
+
+
+@asynccontextmanager
+async def openai_slot(uid):
+    """Hold one of the global OpenAI slots for `uid`, or raise RateLimited."""
+    try:
+        wait = await user_limiter.take(uid)
+        if wait:
+            raise RateLimited(wait, 'user')
+        with telemetry.timed('openai_slot_wait_seconds'):
+            await openai_semaphore.acquire(uid)
+    except RateLimited as e:
+        telemetry.inc('rate_limited_total', reason=e.reason)
+        raise
+    try:
+        yield
+    finally:
+        openai_semaphore.release()
+
+
+@asynccontextmanager
+async def background_slot():
+    """Hold a global OpenAI slot for background work; not subject to per-user limits."""
+    await openai_semaphore.acquire('background')
+    try:
+        yield
+    finally:
+        openai_semaphore.release()
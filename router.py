@@ -0,0 +1,103 @@
+"""Table-driven dispatch for text messages and inline button callbacks.
+
+Text messages are routed with dict lookups, in this order:
+
+1. a handler for the user's state registered with `capture=True` (flows that
+   must receive any text, e.g. an admin typing a recipe title);
+2. a handler for the exact button text;
+3. a handler for the user's state;
+4. the fallback.
+
+Callback data is matched exactly first, then by the longest registered prefix
+using a character trie; the handler receives the rest of the data after the
+prefix. Every route is timed in the `route_seconds` histogram.
+
+Ids in callback data are written in base 36 (`encode_id`), which keeps buttons
+well inside Telegram's 64-byte callback_data limit.
+"""
+import string
+
+from telemetry import timed
+
+_DIGITS = string.digits + string.ascii_lowercase
+
+
+def encode_id(n):
+    """Non-negative integer as a compact base-36 string."""
+    out = ''
+    while True:
+        n, r = divmod(n, 36)
+        out = _DIGITS[r] + out
+        if not n:
+            return out
+
+
+def decode_id(text):
+    return int(text, 36)
+
+
+class Router:
+    def __init__(self, name):
+        self.name = name
+        self._captures = {}  # state -> handler, checked before buttons
+        self._buttons = {}   # button text -> handler
+        self._states = {}    # state -> handler
+        self._exact = {}     # callback data -> handler
+        self._trie = {}      # char -> child node; a node's None key holds the handler for that prefix
+        self._fallback = None
+
+    def _timed(self, fn):
+        return timed('route_seconds', router=self.name, route=fn.__name__)(fn)
+
+    def button(self, *texts):
+        def register(fn):
+            handler = self._timed(fn)
+            for text in texts:
+                self._buttons[text] = handler
+            return fn
+        return register
+
+    def state(self, *states, capture=False):
+        def register(fn):
+            handler = self._timed(fn)
+            for state in states:
+                (self._captures if capture else self._states)[state] = handler
+            return fn
+        return register
+
+    def callback(self, *data, prefix=None):
+        """Route callback data equal to one of `data`, or starting with `prefix`."""
+        def register(fn):
+            handler = self._timed(fn)
+            for d in data:
+                self._exact[d] = handler
+            if prefix is not None:
+                node = self._trie
+                for ch in prefix:
+                    node = node.setdefault(ch, {})
+                node[None] = handler
+            return fn
+        return register
+
+    def fallback(self, fn):
+        self._fallback = self._timed(fn)
+        return fn
+
+    def match_text(self, text, state):
+        """Handler for a text message from a user in `state` (None when idle)."""
+        return (self._captures.get(state) or self._buttons.get(text)
+                or self._states.get(state) or self._fallback)
+
+    def match_callback(self, data):
+        """Return (handler, rest of the data after the matched prefix)."""
+        handler = self._exact.get(data)
+        if handler is not None:
+            return handler, ''
+        node, match = self._trie, (self._fallback, data)
+        for i, ch in enumerate(data):
+            node = node.get(ch)
+            if node is None:
+                break
+            if None in node:
+                match = (node[None], data[i + 1:])
+        return match
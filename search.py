@@ -0,0 +1,120 @@
+"""In-memory inverted index over stored recipes for ingredient search.
+
+The index is built from the store on first use (or at startup via `build_index`).
+New recipes, whether added by this worker or by another one, are picked up by
+the next search: it checks the highest recipe id, and if there are new rows they
+are read on the storage I/O thread and indexed in a worker thread into a new
+index that replaces the old one, so the event loop never parses or indexes rows
+and a search never sees an index being modified.
+"""
+import asyncio
+import math
+import re
+
+STOPWORDS = {
+    'and', 'the', 'with', 'for', 'some', 'any', 'fresh', 'cup', 'cups', 'tbsp', 'tsp',
+    'gram', 'grams', 'pinch', 'of', 'to', 'or', 'in', 'a', 'an', 'have', 'what', 'can', 'cook',
+}
+TITLE_WEIGHT = 2.0
+
+# (postings {token: {recipe_id: weight}}, recipe count, highest indexed recipe id);
+# never modified in place, only replaced by a newer one
+_index = None
+_refresh = None  # task indexing recipes added since, shared by concurrent searches
+
+
+def _normalize(word):
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    if len(word) > 4 and word.endswith('oes'):
+        return word[:-2]
+    if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+        return word[:-1]
+    return word
+
+
+def tokenize(text):
+    """Lowercase word tokens with stopwords dropped and simple plurals folded."""
+    words = re.findall(r'[^\W\d_]+', (text or '').lower())
+    return [_normalize(w) for w in words if len(w) > 2 and w not in STOPWORDS]
+
+
+def _extend(index, items):
+    """A new index with [(recipe_id, receipt)] added to `index` (None for empty).
+    Only the posting lists the new recipes touch are copied; `index` is left as is.
+    """
+    postings, count, last_id = index or ({}, 0, 0)
+    postings = dict(postings)
+    copied = set()
+    for recipe_id, receipt in items:
+        weights = {}
+        for token in tokenize(receipt.get('text', '')):
+            weights[token] = weights.get(token, 0) + 1
+        for token in tokenize(receipt.get('title') or ''):
+            weights[token] = weights.get(token, 0) + TITLE_WEIGHT
+        for token, weight in weights.items():
+            if token not in copied:
+                postings[token] = dict(postings.get(token, ()))
+                copied.add(token)
+            postings[token][recipe_id] = 1 + math.log(weight)
+        last_id = max(last_id, recipe_id)
+    return postings, count + len(items), last_id
+
+
+def build_index(items=None):
+    """(Re)build the index from [(recipe_id, receipt)], or from the store if not given.
+    The new index replaces the old one in a single step, so it can be built in a
+    background thread while searches keep using the previous one.
+    """
+    global _index
+    if items is None:
+        from storage import get_receipt_items
+        items = get_receipt_items()
+    _index = _extend(None, items)
+
+
+async def _catch_up():
+    global _index
+    from storage import get_receipt_items_after, run_io
+    index = _index
+    items = await run_io(get_receipt_items_after, index[2] if index else 0)
+    _index = await asyncio.to_thread(_extend, index, items)
+
+
+async def _sync():
+    """Index recipes added since the last search, by this worker or another one.
+    Only the highest recipe id is read on the event loop; new rows are fetched and
+    indexed off it, and the search waits for them.
+    """
+    global _refresh
+    from storage import last_receipt_id
+    if _index is not None and _index[2] >= last_receipt_id():
+        return
+    if _refresh is None or _refresh.done():
+        _refresh = asyncio.ensure_future(_catch_up())
+    await asyncio.shield(_refresh)
+
+
+async def search_recipes(query, limit=5):
+    """Rank recipes against the tokens in `query`.
+    Returns [(recipe_id, coverage, score)] best first, where coverage is the
+    fraction of distinct query tokens the recipe contains.
+    """
+    await _sync()
+    tokens = set(tokenize(query))
+    if not tokens:
+        return []
+    postings_by_token, doc_count, _ = _index
+    doc_count = max(doc_count, 1)
+    scores = {}
+    hits = {}
+    for token in tokens:
+        postings = postings_by_token.get(token)
+        if not postings:
+            continue
+        idf = math.log(1 + doc_count / len(postings))
+        for recipe_id, weight in postings.items():
+            scores[recipe_id] = scores.get(recipe_id, 0.0) + weight * idf
+            hits[recipe_id] = hits.get(recipe_id, 0) + 1
+    ranked = sorted(scores, key=lambda i: (hits[i], scores[i]), reverse=True)[:limit]
+    return [(i, hits[i] / len(tokens), scores[i]) for i in ranked]
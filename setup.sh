@@ -29,16 +29,8 @@ unset no_proxy
 # Create data directory if it doesn't exist
 mkdir -p data
 
-# Initialize empty JSON files if they don't exist
-if [ ! -f data/receipts.json ]; then
-    echo "[]" > data/receipts.json
-    echo "✅ Created receipts.json"
-fi
-
-if [ ! -f data/comments.json ]; then
-    echo "[]" > data/comments.json
-    echo "✅ Created comments.json"
-fi
+# Recipes and comments live in SQLite (DB_PATH); the database is created on first start
+# and any legacy receipts.json/comments.json files are migrated automatically.
 
 echo "✅ Data directory initialized"
 echo "📦 Installing dependencies..."
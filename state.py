@@ -0,0 +1,84 @@
+"""Per-user conversation state with expiry.
+
+Handlers use a small API: `get(uid)`, `set(uid, state)` and `pop(uid, default)`.
+Two backends are available:
+
+- `MemoryStateStore`: process-local, evicts idle entries after `ttl` seconds
+  and the least recently used ones beyond `max_entries`.
+- `SQLiteStateStore`: kept in the shared database (DB_PATH), so state survives
+  restarts and is visible to every process using the same file. Writes are
+  deferred to the storage I/O thread and committed within milliseconds.
+"""
+import time
+from collections import OrderedDict
+
+import storage
+
+
+class MemoryStateStore:
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # uid -> (expires_at, state)
+
+    def get(self, uid, default=None):
+        entry = self._data.get(uid)
+        if entry is None:
+            return default
+        if entry[0] < time.time():
+            del self._data[uid]
+            return default
+        self._data.move_to_end(uid)
+        return entry[1]
+
+    def set(self, uid, state):
+        self._data[uid] = (time.time() + self.ttl, state)
+        self._data.move_to_end(uid)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def pop(self, uid, default=None):
+        entry = self._data.pop(uid, None)
+        if entry is None or entry[0] < time.time():
+            return default
+        return entry[1]
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteStateStore:
+    NAMESPACE = 'user_state'
+    PRUNE_EVERY = 500  # writes between sweeps of expired rows
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._writes = 0
+
+    def get(self, uid, default=None):
+        entry = storage.kv_get(self.NAMESPACE, str(uid))
+        if entry is None or entry[0] < time.time():
+            return default
+        return entry[1]
+
+    def set(self, uid, state):
+        storage.kv_set_deferred(self.NAMESPACE, str(uid), state, time.time() + self.ttl)
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            storage.run_later(storage.kv_prune, self.NAMESPACE)
+
+    def pop(self, uid, default=None):
+        state = self.get(uid, default)
+        storage.kv_delete_deferred(self.NAMESPACE, str(uid))
+        return state
+
+    def __len__(self):
+        return storage.kv_count(self.NAMESPACE)
+
+
+def make_state_store(backend, ttl, max_entries):
+    if backend == 'memory':
+        return MemoryStateStore(ttl, max_entries)
+    if backend == 'sqlite':
+        return SQLiteStateStore(ttl)
+    raise ValueError(f"Unknown STATE_BACKEND: {backend!r} (expected 'memory' or 'sqlite')")
@@ -0,0 +1,629 @@
+"""SQLite-backed storage for recipes and comments.
+
+Every add is a single INSERT instead of re-reading and rewriting a whole JSON
+file. On first start the legacy `receipts.json` / `comments.json` files from
+DATA_DIR are imported once and renamed to `*.migrated`.
+
+Recipe reads (single recipes, list pages, counts and full-table reads) are
+served from an in-process cache. The table is append-only, so the cache is
+keyed on its highest id and only rows added since (by any connection or
+worker) are read; a browsing tap costs one MAX(id) lookup and no JSON parsing.
+
+Writes run on a single storage I/O thread with its own connection (`run_io`),
+so a write waiting for another worker's lock never stalls the event loop or
+reads on the shared connection; SQLite commits are atomic, so a crash can't
+leave a half-written recipe. Frequent small writes (cache entries, user state,
+ingredient request counts) are deferred: they are queued, merged per key and
+committed together in one transaction by the I/O thread (`flush`).
+
+Recipes are addressed by their row id (`recipe_id`), which never changes or
+gets reused; comments reference it in `comments.recipe_id`. Older databases
+stored the recipe's list position in `comments.recipe_idx` and are converted
+once on start.
+"""
+import asyncio
+import atexit
+import os
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from config import DATA_DIR, DB_PATH
+import telemetry
+from telemetry import timed
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS receipts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS comments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipe_idx INTEGER,  -- legacy list position, superseded by recipe_id
+    recipe_id INTEGER,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ingredient_requests (
+    key TEXT PRIMARY KEY,  -- normalized ingredient list
+    ingredients TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    last_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS kv_cache (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE TABLE IF NOT EXISTS pending_updates (
+    update_id INTEGER PRIMARY KEY,
+    chat TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_pending_updates_chat ON pending_updates (chat, update_id);
+"""
+
+_conn = None
+_lock = threading.Lock()
+
+# table name -> (highest id, [(id, parsed row)], {id: parsed row})
+_cache = {}
+_cache_lock = threading.Lock()  # only held to swap an entry, never while reading or parsing
+cache_stats = {'hits': 0, 'misses': 0}
+
+_io_local = threading.local()  # .conn is set on the storage I/O thread only
+
+# deferred writes, committed by `flush`
+_pending_kv = {}        # (namespace, key) -> (value, expires_at); value None deletes
+_pending_requests = {}  # ingredient list key -> [ingredients, count, last_at]
+_pending_lock = threading.Lock()
+_flush_scheduled = False
+
+PRUNE_EVERY = 500  # writes to a kv namespace between sweeps of its expired rows
+_writes_since_prune = {}  # namespace -> count
+
+
+def _load_json(path, default):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception:
+        return default
+
+
+def get_recipe_title(recipe_text):
+    """Extract title from recipe text (first line or first 50 chars)"""
+    lines = recipe_text.strip().split('\n')
+    # Try to find a title-like line
+    for line in lines[:3]:
+        line = line.strip()
+        if line and not line.startswith('Yield') and not line.startswith('Prep'):
+            return line[:80] if len(line) > 80 else line
+    # Fallback: use first 50 chars
+    return recipe_text[:50].replace('\n', ' ') + '...'
+
+
+def _display_title(receipt):
+    return receipt.get('title') or get_recipe_title(receipt.get('text', ''))
+
+
+def _ensure_title_column(conn):
+    """Add and backfill receipts.title for databases created before titles were stored."""
+    columns = [r[1] for r in conn.execute('PRAGMA table_info(receipts)')]
+    if 'title' not in columns:
+        conn.execute('ALTER TABLE receipts ADD COLUMN title TEXT')
+    rows = conn.execute('SELECT id, data FROM receipts WHERE title IS NULL').fetchall()
+    if rows:
+        conn.executemany('UPDATE receipts SET title = ? WHERE id = ?',
+                         [(_display_title(json.loads(data)), rid) for rid, data in rows])
+    conn.commit()
+
+
+def _migrate_json(conn):
+    """Import legacy JSON files once, then rename them so they are not re-imported.
+    Runs under a write lock so concurrently starting workers don't import twice.
+    """
+    for table, filename in (('receipts', 'receipts.json'), ('comments', 'comments.json')):
+        path = os.path.join(DATA_DIR, filename)
+        if not os.path.exists(path):
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        if not os.path.exists(path):
+            conn.rollback()
+            continue
+        items = _load_json(path, [])
+        has_rows = conn.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone()
+        if items and not has_rows:
+            if table == 'receipts':
+                conn.executemany('INSERT INTO receipts (title, data) VALUES (?, ?)',
+                                 [(_display_title(r), json.dumps(r, ensure_ascii=False)) for r in items])
+            else:
+                conn.executemany('INSERT INTO comments (recipe_idx, data) VALUES (?, ?)',
+                                 [(c.get('recipe_idx'), json.dumps(c, ensure_ascii=False)) for c in items])
+            telemetry.log('storage_migrated', table=table, rows=len(items), source=filename)
+        conn.commit()
+        # renamed only once the rows are committed; if this fails, the next start skips the
+        # import because the table has rows and renames the file then
+        os.replace(path, path + '.migrated')
+
+
+def _ensure_recipe_ids(conn):
+    """Add comments.recipe_id and convert legacy recipe_idx positions to recipe ids."""
+    conn.execute('BEGIN IMMEDIATE')
+    columns = [r[1] for r in conn.execute('PRAGMA table_info(comments)')]
+    if 'recipe_id' not in columns:
+        conn.execute('ALTER TABLE comments ADD COLUMN recipe_id INTEGER')
+    rows = conn.execute('SELECT id, recipe_idx, data FROM comments '
+                        'WHERE recipe_id IS NULL AND recipe_idx IS NOT NULL').fetchall()
+    if rows:
+        ids = [r[0] for r in conn.execute('SELECT id FROM receipts ORDER BY id')]
+        updates = []
+        for comment_id, recipe_idx, data in rows:
+            recipe_id = ids[recipe_idx] if 0 <= recipe_idx < len(ids) else None
+            comment = json.loads(data)
+            comment.pop('recipe_idx', None)
+            comment['recipe_id'] = recipe_id
+            # recipe_idx is cleared so the row isn't converted again
+            updates.append((recipe_id, json.dumps(comment, ensure_ascii=False), comment_id))
+        conn.executemany('UPDATE comments SET recipe_id = ?, recipe_idx = NULL, data = ? WHERE id = ?', updates)
+        telemetry.log('storage_migrated', table='comments', rows=len(updates), change='recipe_ids')
+    conn.execute('DROP INDEX IF EXISTS idx_comments_recipe')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_comments_recipe_id ON comments (recipe_id, id)')
+    conn.commit()
+
+
+def _connect():
+    # timeout: wait for other workers' write locks instead of failing with "database is locked"
+    conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def get_connection():
+    """Return the shared connection, creating the schema and migrating on first use."""
+    global _conn
+    if _conn is None:
+        with _lock:
+            if _conn is None:
+                os.makedirs(DATA_DIR, exist_ok=True)
+                conn = _connect()
+                conn.executescript(SCHEMA)
+                _ensure_title_column(conn)
+                _migrate_json(conn)
+                _ensure_recipe_ids(conn)
+                conn.execute('DELETE FROM kv_cache WHERE expires_at < ?', (time.time(),))
+                conn.commit()
+                _conn = conn
+    return _conn
+
+
+def _start_io_thread():
+    _io_local.conn = None  # connected on first use
+
+
+_io = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage-io', initializer=_start_io_thread)
+
+
+@contextmanager
+def _db():
+    """Connection for the calling thread: the I/O thread's own, else the shared one under `_lock`."""
+    if hasattr(_io_local, 'conn'):
+        if _io_local.conn is None:
+            get_connection()  # schema and migrations
+            _io_local.conn = _connect()
+        yield _io_local.conn
+        return
+    conn = get_connection()
+    with _lock:
+        yield conn
+
+
+async def run_io(fn, *args):
+    """Run a storage function on the storage I/O thread and return its result."""
+    return await asyncio.get_running_loop().run_in_executor(_io, fn, *args)
+
+
+def _read_cached(table):
+    """Return ([(id, parsed row)], {id: parsed row}) of `table`, reading only rows added
+    since the last call. The cached rows are shared between callers, which must not
+    modify them. Rows are parsed after the connection is released, so a large read
+    doesn't hold up queries from the event loop.
+    """
+    cached_id, items, by_id = _cache.get(table, (0, [], {}))
+    with _db() as conn:
+        last_id = conn.execute(f'SELECT MAX(id) FROM {table}').fetchone()[0] or 0
+        rows = [] if last_id == cached_id else conn.execute(
+            f'SELECT id, data FROM {table} WHERE id > ? AND id <= ? ORDER BY id', (cached_id, last_id)).fetchall()
+    if last_id == cached_id:
+        cache_stats['hits'] += 1
+        return items, by_id
+    cache_stats['misses'] += 1
+    added = [(r[0], json.loads(r[1])) for r in rows]
+    items = items + added
+    by_id = {**by_id, **dict(added)}
+    with _cache_lock:
+        if _cache.get(table, (0,))[0] < last_id:
+            _cache[table] = (last_id, items, by_id)
+    return items, by_id
+
+
+@timed('storage_seconds', op='get_receipts')
+def get_receipts():
+    return [r for _, r in _read_cached('receipts')[0]]
+
+
+@timed('storage_seconds', op='get_receipt_items')
+def get_receipt_items():
+    """All recipes as [(recipe_id, receipt)], oldest first."""
+    return list(_read_cached('receipts')[0])
+
+
+@timed('storage_seconds', op='get_receipt_items_after')
+def get_receipt_items_after(after_id):
+    """Recipes added after `after_id`, as [(recipe_id, receipt)], oldest first."""
+    with _db() as conn:
+        rows = conn.execute('SELECT id, data FROM receipts WHERE id > ? ORDER BY id', (after_id,)).fetchall()
+    return [(r[0], json.loads(r[1])) for r in rows]
+
+
+@timed('storage_seconds', op='last_receipt_id')
+def last_receipt_id():
+    """Highest recipe id, or 0 when there are none."""
+    with _db() as conn:
+        return conn.execute('SELECT MAX(id) FROM receipts').fetchone()[0] or 0
+
+
+@timed('storage_seconds', op='get_receipt')
+def get_receipt(recipe_id):
+    """One recipe by id, or None. Served from the read cache; don't modify it."""
+    return _read_cached('receipts')[1].get(recipe_id)
+
+
+@timed('storage_seconds', op='recipe_id_at')
+def recipe_id_at(position):
+    """Id of the recipe at a list position, for links created before recipes had ids."""
+    items = _read_cached('receipts')[0]
+    return items[position][0] if 0 <= position < len(items) else None
+
+
+@timed('storage_seconds', op='add_receipt')
+def add_receipt(receipt):
+    """Store a recipe and return its recipe_id."""
+    with _db() as conn:
+        cur = conn.execute('INSERT INTO receipts (title, data) VALUES (?, ?)',
+                           (_display_title(receipt), json.dumps(receipt, ensure_ascii=False)))
+        conn.commit()
+    return cur.lastrowid
+
+
+@timed('storage_seconds', op='add_receipts')
+def add_receipts(receipts):
+    """Store many recipes in one transaction. Returns their recipe_ids."""
+    with _db() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            ids = [conn.execute('INSERT INTO receipts (title, data) VALUES (?, ?)',
+                                (_display_title(r), json.dumps(r, ensure_ascii=False))).lastrowid
+                   for r in receipts]
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return ids
+
+
+@timed('storage_seconds', op='get_recipe_titles_page')
+def get_recipe_titles_page(offset=0, limit=8):
+    """Return ([(recipe_id, title), ...], total) from the read cache."""
+    items = _read_cached('receipts')[0]
+    return [(recipe_id, _display_title(r)) for recipe_id, r in items[offset:offset + limit]], len(items)
+
+
+@timed('storage_seconds', op='add_comment')
+def add_comment(comment):
+    with _db() as conn:
+        conn.execute('INSERT INTO comments (recipe_id, data) VALUES (?, ?)',
+                     (comment.get('recipe_id'), json.dumps(comment, ensure_ascii=False)))
+        conn.commit()
+
+
+def _comments_page(where, params, offset, limit):
+    with _db() as conn:
+        total = conn.execute(f'SELECT COUNT(*) FROM comments {where}', params).fetchone()[0]
+        rows = conn.execute(f'SELECT data FROM comments {where} ORDER BY id LIMIT ? OFFSET ?',
+                            (*params, limit, offset)).fetchall()
+    return [json.loads(r[0]) for r in rows], total
+
+
+@timed('storage_seconds', op='get_recipe_comments')
+def get_recipe_comments(recipe_id, offset=0, limit=10):
+    """Return (comments, total) for one recipe using the recipe_id index."""
+    return _comments_page('WHERE recipe_id = ?', (recipe_id,), offset, limit)
+
+
+@timed('storage_seconds', op='get_comments_page')
+def get_comments_page(offset=0, limit=10):
+    """Return (comments, total) across all recipes, oldest first."""
+    return _comments_page('', (), offset, limit)
+
+
+@timed('storage_seconds', op='kv_get')
+def kv_get(namespace, key):
+    """Return (expires_at, value) of a persisted cache entry, or None.
+    Sees deferred writes that are not committed yet.
+    """
+    pending = _pending_kv.get((namespace, key))
+    if pending is not None:
+        return None if pending[0] is None else (pending[1], pending[0])
+    with _db() as conn:
+        row = conn.execute('SELECT expires_at, value FROM kv_cache WHERE namespace = ? AND key = ?',
+                           (namespace, key)).fetchone()
+    return (row[0], json.loads(row[1])) if row else None
+
+
+@timed('storage_seconds', op='kv_set')
+def kv_set(namespace, key, value, expires_at):
+    with _db() as conn:
+        conn.execute('INSERT OR REPLACE INTO kv_cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+                     (namespace, key, json.dumps(value, ensure_ascii=False), expires_at))
+        conn.commit()
+
+
+@timed('storage_seconds', op='kv_items')
+def kv_items(namespace, limit):
+    """Return up to `limit` unexpired (key, expires_at, value) rows, newest first."""
+    with _db() as conn:
+        rows = conn.execute('SELECT key, expires_at, value FROM kv_cache WHERE namespace = ? AND expires_at >= ? '
+                            'ORDER BY expires_at DESC LIMIT ?', (namespace, time.time(), limit)).fetchall()
+    return [(k, e, json.loads(v)) for k, e, v in rows]
+
+
+@timed('storage_seconds', op='kv_delete')
+def kv_delete(namespace, key):
+    with _db() as conn:
+        conn.execute('DELETE FROM kv_cache WHERE namespace = ? AND key = ?', (namespace, key))
+        conn.commit()
+
+
+@timed('storage_seconds', op='kv_prune')
+def kv_prune(namespace):
+    """Drop expired entries of one namespace."""
+    with _db() as conn:
+        conn.execute('DELETE FROM kv_cache WHERE namespace = ? AND expires_at < ?', (namespace, time.time()))
+        conn.commit()
+
+
+@timed('storage_seconds', op='kv_count')
+def kv_count(namespace):
+    with _db() as conn:
+        return conn.execute('SELECT COUNT(*) FROM kv_cache WHERE namespace = ? AND expires_at >= ?',
+                            (namespace, time.time())).fetchone()[0]
+
+
+def run_later(fn, *args):
+    """Run a storage function on the I/O thread without waiting for it."""
+    try:
+        _io.submit(fn, *args)
+    except RuntimeError:  # interpreter shutting down; deferred writes are flushed at exit
+        pass
+
+
+def _schedule_flush():
+    global _flush_scheduled
+    if not _flush_scheduled:
+        _flush_scheduled = True
+        run_later(flush)
+
+
+def kv_set_deferred(namespace, key, value, expires_at):
+    """Queue a `kv_set`; readers of this process see it at once via `kv_get`."""
+    with _pending_lock:
+        _pending_kv[(namespace, key)] = (value, expires_at)
+        _schedule_flush()
+
+
+def kv_delete_deferred(namespace, key):
+    with _pending_lock:
+        _pending_kv[(namespace, key)] = (None, 0)
+        _schedule_flush()
+
+
+def record_ingredient_request(key, ingredients):
+    """Count one AI request for the normalized ingredient list `key` (deferred)."""
+    with _pending_lock:
+        entry = _pending_requests.get(key)
+        if entry is None:
+            _pending_requests[key] = [ingredients, 1, time.time()]
+        else:
+            entry[0], entry[1], entry[2] = ingredients, entry[1] + 1, time.time()
+        _schedule_flush()
+
+
+@timed('storage_seconds', op='flush')
+def flush():
+    """Commit all deferred writes in one transaction. Scheduled on the I/O thread
+    whenever writes are queued, so writes queued while a commit is in progress are
+    merged into the next one.
+    """
+    global _flush_scheduled
+    with _pending_lock:
+        _flush_scheduled = False
+        kv = dict(_pending_kv)
+        requests = _pending_requests.copy()
+        _pending_requests.clear()
+    if not kv and not requests:
+        return
+    try:
+        with _db() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany('INSERT OR REPLACE INTO kv_cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+                                 [(ns, k, json.dumps(v, ensure_ascii=False), e)
+                                  for (ns, k), (v, e) in kv.items() if v is not None])
+                conn.executemany('DELETE FROM kv_cache WHERE namespace = ? AND key = ?',
+                                 [key for key, (v, _) in kv.items() if v is None])
+                conn.executemany('INSERT INTO ingredient_requests (key, ingredients, count, last_at) VALUES (?, ?, ?, ?) '
+                                 'ON CONFLICT (key) DO UPDATE SET count = count + excluded.count, '
+                                 'last_at = excluded.last_at, ingredients = excluded.ingredients',
+                                 [(k, i, c, t) for k, (i, c, t) in requests.items()])
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+    except Exception as e:
+        telemetry.log('storage_flush_failed', level='error', writes=len(kv) + len(requests), error=repr(e))
+        with _pending_lock:
+            for key, (i, c, t) in requests.items():
+                entry = _pending_requests.setdefault(key, [i, 0, t])
+                entry[1] += c
+        return
+    with _pending_lock:
+        for key, entry in kv.items():
+            if _pending_kv.get(key) is entry:  # not overwritten while committing
+                del _pending_kv[key]
+
+
+def pending_writes():
+    return len(_pending_kv) + len(_pending_requests)
+
+
+atexit.register(flush)
+
+
+@timed('storage_seconds', op='popular_ingredient_requests')
+def popular_ingredient_requests(min_count, limit, offset=0):
+    """Most requested ingredient lists as [(key, ingredients, count)], most popular first."""
+    with _db() as conn:
+        return conn.execute('SELECT key, ingredients, count FROM ingredient_requests WHERE count >= ? '
+                            'ORDER BY count DESC, last_at DESC LIMIT ? OFFSET ?', (min_count, limit, offset)).fetchall()
+
+
+@timed('storage_seconds', op='prune_ingredient_requests')
+def prune_ingredient_requests(older_than, max_count=1):
+    """Forget rarely requested lists not seen since `older_than` (a timestamp)."""
+    with _db() as conn:
+        conn.execute('DELETE FROM ingredient_requests WHERE count <= ? AND last_at < ?', (max_count, older_than))
+        conn.commit()
+
+
+def _due_for_prune(namespace):
+    count = _writes_since_prune[namespace] = _writes_since_prune.get(namespace, 0) + 1
+    return count % PRUNE_EVERY == 0
+
+
+@timed('storage_seconds', op='acquire_lease')
+def acquire_lease(name, seconds):
+    """Claim `name` for `seconds` across all processes sharing the database.
+    Returns True for exactly one caller until the lease expires.
+    """
+    with _db() as conn:
+        now = time.time()
+        if _due_for_prune('lease'):
+            # per-update leases would otherwise pile up until the next restart
+            conn.execute('DELETE FROM kv_cache WHERE namespace = ? AND expires_at < ?', ('lease', now))
+        else:
+            conn.execute('DELETE FROM kv_cache WHERE namespace = ? AND key = ? AND expires_at < ?', ('lease', name, now))
+        cur = conn.execute('INSERT OR IGNORE INTO kv_cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+                           ('lease', name, json.dumps(os.getpid()), now + seconds))
+        conn.commit()
+    return cur.rowcount == 1
+
+
+@timed('storage_seconds', op='release_lease')
+def release_lease(name):
+    """Give up a lease taken with `acquire_lease` before it expires."""
+    with _db() as conn:
+        conn.execute('DELETE FROM kv_cache WHERE namespace = ? AND key = ?', ('lease', name))
+        conn.commit()
+
+
+@timed('storage_seconds', op='add_pending_update')
+def add_pending_update(update_id, chat, seconds):
+    """Record an accepted update of `chat` that no process has finished yet.
+    Forgotten after `seconds`, so a worker that died with it doesn't hold up the chat.
+    """
+    with _db() as conn:
+        now = time.time()
+        if _due_for_prune('pending'):
+            conn.execute('DELETE FROM pending_updates WHERE expires_at < ?', (now,))
+        conn.execute('INSERT OR REPLACE INTO pending_updates (update_id, chat, expires_at) VALUES (?, ?, ?)',
+                     (update_id, str(chat), now + seconds))
+        conn.commit()
+
+
+@timed('storage_seconds', op='first_pending_update')
+def first_pending_update(chat):
+    """Lowest update_id of `chat` that any process still has pending, or None."""
+    with _db() as conn:
+        return conn.execute('SELECT MIN(update_id) FROM pending_updates WHERE chat = ? AND expires_at >= ?',
+                            (str(chat), time.time())).fetchone()[0]
+
+
+@timed('storage_seconds', op='remove_pending_update')
+def remove_pending_update(update_id):
+    with _db() as conn:
+        conn.execute('DELETE FROM pending_updates WHERE update_id = ?', (update_id,))
+        conn.commit()
+
+
+@timed('storage_seconds', op='reserve_pace')
+def reserve_pace(name, interval, tolerance, hold_until=None):
+    """Cross-process version of `outbound._Pace.reserve` (GCRA) for `name`: book the
+    next slot and return how long to wait for it. With `hold_until` (a timestamp)
+    only push the next slot back to it, e.g. after a 429.
+    """
+    with _db() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            if _due_for_prune('pace'):
+                conn.execute('DELETE FROM kv_cache WHERE namespace = ? AND expires_at < ?', ('pace', now))
+            row = conn.execute('SELECT value FROM kv_cache WHERE namespace = ? AND key = ?', ('pace', name)).fetchone()
+            tat = max(json.loads(row[0]) if row else 0.0, now)
+            if hold_until is None:
+                delay = max(0.0, tat - tolerance - now)
+                tat += interval
+            else:
+                delay, tat = 0.0, max(tat, hold_until)
+            # once `tat` has passed the row carries no information
+            conn.execute('INSERT OR REPLACE INTO kv_cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+                         ('pace', name, json.dumps(tat), tat))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return delay
+
+
+@timed('storage_seconds', op='take_token')
+def take_token(name, rate, burst):
+    """Cross-process version of `ratelimit.TokenBucket.take` for bucket `name`
+    (`rate` tokens per second, up to `burst`). Returns 0 on success, else seconds
+    until a token is available.
+    """
+    with _db() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            if _due_for_prune('bucket'):
+                conn.execute('DELETE FROM kv_cache WHERE namespace = ? AND expires_at < ?', ('bucket', now))
+            row = conn.execute('SELECT value FROM kv_cache WHERE namespace = ? AND key = ?', ('bucket', name)).fetchone()
+            tokens, updated = json.loads(row[0]) if row else (burst, now)
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            # a bucket that has refilled completely carries no information
+            conn.execute('INSERT OR REPLACE INTO kv_cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+                         ('bucket', name, json.dumps([tokens, now]), now + (burst - tokens) / rate))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return wait
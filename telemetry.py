@@ -0,0 +1,159 @@
+"""Process-local metrics in the Prometheus text format, and structured logs.
+
+Counters and histograms are kept in plain dicts keyed by metric name and
+label values; gauges are callbacks read at scrape time. `render()` produces
+the text served on `/metrics`. With several worker processes every worker
+keeps its own numbers, and each scrape reaches whichever worker answers.
+
+`log()` prints one JSON object per line, tagged with the trace id of the
+update being processed (see `set_trace_id`).
+"""
+import functools
+import inspect
+import json
+import time
+from contextvars import ContextVar
+
+# seconds; covers fast storage reads up to slow OpenAI generations
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_help = {}
+_counters = {}    # name -> {label items: value}
+_histograms = {}  # name -> {label items: [bucket counts..., count, sum]}
+_gauges = {}      # name -> callable returning a number or [(labels, value)]
+
+_trace_id = ContextVar('trace_id', default=None)
+_started_at = time.time()
+
+
+def describe(name, help_text):
+    _help[name] = help_text
+
+
+def inc(name, value=1, **labels):
+    series = _counters.setdefault(name, {})
+    key = tuple(sorted(labels.items()))
+    series[key] = series.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    series = _histograms.setdefault(name, {})
+    key = tuple(sorted(labels.items()))
+    counts = series.get(key)
+    if counts is None:
+        counts = series[key] = [0] * (len(BUCKETS) + 2)
+    for i, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+            counts[i] += 1
+    counts[-2] += 1
+    counts[-1] += seconds
+
+
+def gauge(name, fn, help_text=None):
+    """Register `fn`, returning a number or [(labels dict, value)], to be read on each scrape."""
+    _gauges[name] = fn
+    if help_text:
+        describe(name, help_text)
+
+
+class timed:
+    """Record the duration of a block (`with timed(...)`) or of every call of a
+    decorated function in histogram `name`, and count failures in `<name>_errors_total`.
+    """
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.name, time.monotonic() - self._start, **self.labels)
+        if exc_type is not None:
+            inc(f'{self.name}_errors_total', **self.labels)
+        return False
+
+    def __call__(self, fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with timed(self.name, **self.labels):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with timed(self.name, **self.labels):
+                    return fn(*args, **kwargs)
+        return wrapper
+
+
+def _resident_memory():
+    """Current RSS in bytes (Linux only; no series elsewhere)."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return []
+
+
+gauge('process_resident_memory_bytes', _resident_memory, 'Resident memory of this worker')
+gauge('process_start_time_seconds', lambda: _started_at, 'Start time of this worker (identifies it across scrapes)')
+
+
+def _format_labels(items):
+    if not items:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in items)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + '}'
+
+
+def _header(lines, name, kind):
+    if name in _help:
+        lines.append(f'# HELP {name} {_help[name]}')
+    lines.append(f'# TYPE {name} {kind}')
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for name, series in sorted(_counters.items()):
+        _header(lines, name, 'counter')
+        for key, value in series.items():
+            lines.append(f'{name}{_format_labels(key)} {value}')
+    for name, series in sorted(_histograms.items()):
+        _header(lines, name, 'histogram')
+        for key, counts in series.items():
+            for bound, count in zip(BUCKETS, counts):
+                lines.append(f'{name}_bucket{_format_labels(key + (("le", bound),))} {count}')
+            lines.append(f'{name}_bucket{_format_labels(key + (("le", "+Inf"),))} {counts[-2]}')
+            lines.append(f'{name}_count{_format_labels(key)} {counts[-2]}')
+            lines.append(f'{name}_sum{_format_labels(key)} {counts[-1]:.6f}')
+    for name, fn in sorted(_gauges.items()):
+        try:
+            value = fn()
+        except Exception as e:
+            log('gauge_failed', level='error', gauge=name, error=str(e))
+            continue
+        _header(lines, name, 'gauge')
+        for labels, v in (value if isinstance(value, list) else [({}, value)]):
+            lines.append(f'{name}{_format_labels(tuple(sorted(labels.items())))} {v}')
+    return '\n'.join(lines) + '\n'
+
+
+def set_trace_id(trace_id):
+    """Tag logs from the current task (and tasks it starts) with `trace_id`."""
+    _trace_id.set(trace_id)
+
+
+def log(event, level='info', **fields):
+    record = {'ts': round(time.time(), 3), 'level': level, 'event': event}
+    trace_id = _trace_id.get()
+    if trace_id is not None:
+        record['trace_id'] = trace_id
+    record.update(fields)
+    print(json.dumps(record, ensure_ascii=False, default=str), flush=True)
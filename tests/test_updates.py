@@ -0,0 +1,42 @@
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+
+# storage reads DATA_DIR / DB_PATH on import
+_data_dir = tempfile.mkdtemp(prefix='cooking-bot-test-')
+os.environ['DATA_DIR'] = _data_dir
+os.environ['DB_PATH'] = os.path.join(_data_dir, 'cooking_bot.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import first_pending_update  # noqa: E402
+from updates import UpdateDispatcher  # noqa: E402
+
+
+def message(update_id, chat_id):
+    return {'update_id': update_id, 'message': {'chat': {'id': chat_id}, 'text': 'hi'}}
+
+
+class StopTest(unittest.IsolatedAsyncioTestCase):
+    async def test_stop_forgets_queued_updates(self):
+        started = asyncio.Event()
+
+        async def handler(data):
+            started.set()
+            await asyncio.sleep(60)
+
+        dispatcher = UpdateDispatcher(handler, workers=1, queue_size=10, shared_order=True)
+        dispatcher.start()
+        for update_id in (1, 2, 3):
+            self.assertEqual(await dispatcher.submit(message(update_id, 7)), 'queued')
+        await started.wait()
+        self.assertEqual(first_pending_update(7), 1)
+
+        await dispatcher.stop(timeout=0.1)
+
+        self.assertIsNone(first_pending_update(7))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+"""Background processing of webhook updates.
+
+`handle_webhook` only validates and enqueues an update, so Telegram's request
+returns immediately instead of waiting for OpenAI. Each chat has its own queue
+and at most one update in progress, which keeps its updates in order; a pool
+of consumer tasks takes whichever chat is ready next, so a slow AI call only
+holds up its own chat. With several worker processes every accepted update is
+also recorded in storage until it is processed, and a consumer only runs a
+chat's update once it is the lowest one pending in any process, so a process
+receiving the chat's next update waits for the earlier one instead of running
+it against stale state.
+The number of queued updates is bounded; when full the webhook answers 503 and
+Telegram redelivers the update later.
+"""
+import asyncio
+from collections import OrderedDict, deque
+
+from storage import (acquire_lease, add_pending_update, first_pending_update, release_lease,
+                     remove_pending_update, run_io)
+import telemetry
+
+
+def chat_key(data):
+    """Chat (or user) id an update belongs to, used to keep per-chat ordering."""
+    for field in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if data.get(field):
+            return data[field].get('chat', {}).get('id')
+    callback = data.get('callback_query')
+    if callback:
+        message = callback.get('message') or {}
+        return message.get('chat', {}).get('id') or callback.get('from', {}).get('id')
+    for field in ('inline_query', 'chosen_inline_result', 'pre_checkout_query', 'shipping_query'):
+        if data.get(field):
+            return data[field].get('from', {}).get('id')
+    return data.get('update_id')
+
+
+class UpdateDispatcher:
+    PENDING_TTL = 600  # seconds an accepted update holds up later ones of its chat in other processes
+    ORDER_RETRY = 0.2  # seconds before checking again whether a chat's earlier update is done elsewhere
+
+    def __init__(self, handler, workers, queue_size, dedup_size=10000, shared_dedup=False, shared_order=False):
+        self.handler = handler  # async callable taking the raw update dict
+        self.workers = workers  # updates processed at once, each from a different chat
+        self.queue_size = queue_size
+        self.shared_dedup = shared_dedup  # also de-duplicate across worker processes via storage
+        self.shared_order = shared_order  # also keep each chat in order across worker processes
+        self._chats = {}  # chat key -> deque of its updates not processed yet, the first one in progress
+        self._ready = asyncio.Queue()  # chats with an update waiting and none in progress
+        self._depth = 0
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._seen = OrderedDict()
+        self._dedup_size = dedup_size
+        self._tasks = []
+        self.stats = {'queued': 0, 'duplicates': 0, 'rejected': 0, 'processed': 0, 'errors': 0}
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._consume()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=10):
+        """Let queued updates finish (up to `timeout` seconds), then cancel the consumers."""
+        try:
+            await asyncio.wait_for(self._drained.wait(), timeout)
+        except asyncio.TimeoutError:
+            telemetry.log('updates_dropped', level='warning', count=self.depth())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.shared_order:
+            # these will never run here; their rows would hold up the chats' next updates in other processes
+            for updates in self._chats.values():
+                for data in updates:
+                    if data.get('update_id') is None:
+                        continue
+                    try:
+                        await run_io(remove_pending_update, data['update_id'])
+                    except Exception as e:
+                        telemetry.log('update_order_failed', level='error', update_id=data['update_id'],
+                                      error=repr(e))
+
+    def depth(self):
+        return self._depth
+
+    async def _is_duplicate(self, update_id):
+        if update_id is None:
+            return False
+        if update_id in self._seen:
+            return True
+        self._seen[update_id] = None
+        while len(self._seen) > self._dedup_size:
+            self._seen.popitem(last=False)
+        if not self.shared_dedup:
+            return False
+        try:
+            return not await run_io(acquire_lease, f'update:{update_id}', 3600)
+        except BaseException:
+            self._seen.pop(update_id, None)  # so Telegram's redelivery isn't answered as a duplicate
+            raise
+
+    async def _forget(self, update_id):
+        """Undo `_is_duplicate` for an update that wasn't queued after all, so Telegram's retry is accepted."""
+        self._seen.pop(update_id, None)
+        if self.shared_dedup and update_id is not None:
+            try:
+                await run_io(release_lease, f'update:{update_id}')
+            except Exception as e:
+                telemetry.log('update_forget_failed', level='error', update_id=update_id, error=repr(e))
+
+    async def submit(self, data):
+        """Enqueue a raw update. Returns 'queued', 'duplicate' or 'full'."""
+        update_id = data.get('update_id')
+        if self._depth >= self.queue_size:
+            self.stats['rejected'] += 1
+            return 'full'
+        if await self._is_duplicate(update_id):
+            self.stats['duplicates'] += 1
+            return 'duplicate'
+        if self._depth >= self.queue_size:
+            # Filled up while checking for duplicates
+            await self._forget(update_id)
+            self.stats['rejected'] += 1
+            return 'full'
+        key = chat_key(data)
+        if self.shared_order and update_id is not None:
+            # Recorded before Telegram gets its answer (which it normally waits for before sending
+            # the chat's next update), so a worker that receives the next one runs it after this
+            try:
+                await run_io(add_pending_update, update_id, key, self.PENDING_TTL)
+            except BaseException:
+                await self._forget(update_id)
+                raise
+        self._depth += 1
+        self._drained.clear()
+        self.stats['queued'] += 1
+        updates = self._chats.get(key)
+        if updates is not None:
+            updates.append(data)  # runs once the chat's earlier updates are done
+        else:
+            self._chats[key] = deque([data])
+            self._ready.put_nowait(key)
+        return 'queued'
+
+    async def _is_next(self, key, data):
+        """Whether no other process has an earlier update of the chat still pending."""
+        update_id = data.get('update_id')
+        if not self.shared_order or update_id is None:
+            return True
+        first = await run_io(first_pending_update, key)
+        return first is None or first >= update_id
+
+    def _retry_later(self, key):
+        asyncio.get_running_loop().call_later(self.ORDER_RETRY, self._ready.put_nowait, key)
+
+    async def _consume(self):
+        while True:
+            key = await self._ready.get()
+            updates = self._chats[key]
+            data = updates[0]
+            try:
+                if not await self._is_next(key, data):
+                    self._retry_later(key)  # another worker process still has earlier updates of this chat
+                    continue
+            except Exception as e:
+                telemetry.log('update_order_failed', level='error', update_id=data.get('update_id'), error=repr(e))
+                self._retry_later(key)
+                continue
+            try:
+                await self.handler(data)
+                self.stats['processed'] += 1
+            except Exception as e:
+                self.stats['errors'] += 1
+                telemetry.log('update_failed', level='error', update_id=data.get('update_id'), error=repr(e))
+            finally:
+                await self._done(key, data)
+
+    async def _done(self, key, data):
+        update_id = data.get('update_id')
+        if self.shared_order and update_id is not None:
+            try:
+                # queued after the handler's deferred state writes, so the next worker sees them
+                await run_io(remove_pending_update, update_id)
+            except Exception as e:
+                # the chat's later updates in other processes wait until the row expires
+                telemetry.log('update_order_failed', level='error', update_id=update_id, error=repr(e))
+        updates = self._chats[key]
+        updates.popleft()
+        if updates:
+            self._ready.put_nowait(key)  # behind chats that are already waiting
+        else:
+            del self._chats[key]
+        self._depth -= 1
+        if not self._depth:
+            self._drained.set()